@@ -1,3 +1,5 @@
+import contextlib
+
 # -------------
 # Guideline Lib
 # -------------
@@ -37,4 +39,119 @@ def setGuidelineLibValue(guideline, key, value):
             lib.pop(key)
     else:
         lib[key] = value
-    setGuidelineLib(guideline, lib)
\ No newline at end of file
+    setGuidelineLib(guideline, lib)
+
+# --------------------
+# Guideline Visibility
+# --------------------
+
+def setGuidelineVisible(guideline, value):
+    try:
+        guideline.visible = value
+    except AttributeError:
+        pass
+
+# -----------------------
+# Guideline Notifications
+# -----------------------
+
+@contextlib.contextmanager
+def holdGuidelineNotifications(guidelines, note=None):
+    """
+    Hold the notifications of the dispatchers that
+    the guidelines post to until the block is done.
+    Repeated notifications are posted once.
+
+    >>> import defcon
+    >>> font = defcon.Font()
+    >>> glyph = font.newGlyph("a")
+    >>> for x in range(20):
+    ...     glyph.appendGuideline(dict(x=x, y=0, angle=90))
+    >>> font.appendGuideline(dict(x=0, y=10, angle=0))
+    >>> guidelines = glyph.guidelines + font.guidelines
+    >>> counter = _NotificationCounter(glyph, glyph.layer, font)
+    >>> with holdGuidelineNotifications(guidelines):
+    ...     for guideline in guidelines:
+    ...         guideline.y += 5
+    >>> counter.counts["Glyph.GuidelinesChanged"], counter.counts["Glyph.Changed"]
+    (1, 1)
+    >>> counter.counts["Font.GuidelinesChanged"], counter.counts["Font.Changed"]
+    (1, 1)
+    """
+    parents = []
+    for guideline in guidelines:
+        if hasattr(guideline, "naked"):
+            guideline = guideline.naked()
+        parent = guideline.glyph
+        if parent is None:
+            parent = guideline.font
+        if parent is None:
+            continue
+        if any(p is parent for p in parents):
+            continue
+        parents.append(parent)
+    with holdGuidelineParentNotifications(parents, note=note):
+        yield
+
+@contextlib.contextmanager
+def holdGuidelineParentNotifications(parents, note=None):
+    """
+    Hold the notifications of the dispatchers of
+    the glyphs and fonts until the block is done.
+    The parents and the objects that contain them
+    post their own notifications while the held
+    guideline notifications are released. Those
+    are held as well and released from the glyph
+    up to the font, so that each is posted once
+    no matter how many guidelines changed.
+    """
+    dispatchers = []
+    containers = []
+    for parent in parents:
+        dispatcher = parent.dispatcher
+        if dispatcher is None:
+            continue
+        if not any(d is dispatcher for d in dispatchers):
+            dispatchers.append(dispatcher)
+        for depth, container in enumerate(_getContainers(parent)):
+            if not any(c is container for d, c in containers):
+                containers.append((depth, container))
+    containers.sort(key=lambda item: -item[0])
+    for dispatcher in dispatchers:
+        dispatcher.holdNotifications(note=note)
+    try:
+        yield
+    finally:
+        for depth, container in containers:
+            container.dispatcher.holdNotifications(observable=container, note=note)
+        for dispatcher in dispatchers:
+            dispatcher.releaseHeldNotifications()
+        for depth, container in containers:
+            container.dispatcher.releaseHeldNotifications(observable=container)
+
+def _getContainers(parent):
+    # from the font down to the parent
+    containers = [parent]
+    for name in ("layer", "layerSet", "font"):
+        container = getattr(parent, name, None)
+        if container is None or any(c is container for c in containers):
+            continue
+        containers.append(container)
+    containers.reverse()
+    return containers
+
+class _NotificationCounter:
+
+    def __init__(self, *observables):
+        self.counts = {}
+        for observable in observables:
+            observable.addObserver(self, "count", None)
+
+    def count(self, notification):
+        name = notification.name
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
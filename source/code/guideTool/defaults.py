@@ -141,9 +141,15 @@ defaults = {
     "smartMacros" : defaultMacros,
     "snapToPoint" : True,
     "snapToFuturePoint" : True,
+    "snapToOffCurvePoint" : False,
+    "snapToExtremePoint" : False,
+    "snapToAnchor" : False,
+    "snapToVerticalMetrics" : False,
+    "snapToGuidelineIntersection" : False,
     "hapticFeedbackOnSnapTo" : True,
     "wantItalicAngle" : True,
     "highlightAlphaScale" : 0.15,
+    "smartGuideDelay" : 0.05,
     "swatchColors" : [
         (1, 0, 0, 1),
         (0, 1, 0, 1),
@@ -180,6 +186,11 @@ class GuideToolDefaultsWindowController(ezui.WindowController):
         : Snap To:
         [ ] Point                @snapToPoint
         [ ] Future Point         @snapToFuturePoint
+        [ ] Off Curve Point      @snapToOffCurvePoint
+        [ ] Extreme Point        @snapToExtremePoint
+        [ ] Anchor               @snapToAnchor
+        [ ] Vertical Metrics     @snapToVerticalMetrics
+        [ ] Guide Intersection   @snapToGuidelineIntersection
         [ ] Use haptic feedback. @hapticFeedbackOnSnapTo
 
         : Vertical Angle:
@@ -192,6 +203,9 @@ class GuideToolDefaultsWindowController(ezui.WindowController):
         |-------|
         > (+-)                   @colorsTableAddRemoveButton
 
+        : Smart Guide Delay:
+        ---X---                  @smartGuideDelay
+
         : Macros:
         [[__]]                   @smartMacros
         """
@@ -211,6 +225,21 @@ class GuideToolDefaultsWindowController(ezui.WindowController):
             snapToFuturePoint=dict(
                 value=settings["snapToFuturePoint"]
             ),
+            snapToOffCurvePoint=dict(
+                value=settings["snapToOffCurvePoint"]
+            ),
+            snapToExtremePoint=dict(
+                value=settings["snapToExtremePoint"]
+            ),
+            snapToAnchor=dict(
+                value=settings["snapToAnchor"]
+            ),
+            snapToVerticalMetrics=dict(
+                value=settings["snapToVerticalMetrics"]
+            ),
+            snapToGuidelineIntersection=dict(
+                value=settings["snapToGuidelineIntersection"]
+            ),
             hapticFeedbackOnSnapTo=dict(
                 value=settings["hapticFeedbackOnSnapTo"]
             ),
@@ -236,6 +265,11 @@ class GuideToolDefaultsWindowController(ezui.WindowController):
                 showColumnTitles=False,
                 height=100
             ),
+            smartGuideDelay=dict(
+                minValue=0,
+                maxValue=0.5,
+                value=settings["smartGuideDelay"]
+            ),
             smartMacros=dict(
                 value=settings["smartMacros"],
                 height=200
@@ -5,8 +5,20 @@ from mojo.extensions import getExtensionDefault
 from mojo.UI import getDefault
 from mojo.events import postEvent
 from .defaults import extensionIdentifier
-from .smart import parseRules, matchGlyphRules, parseMacros
-from .compatibility import getGuidelineLibValue, setGuidelineLibValue
+from .smart import (
+    parseRules,
+    matchGlyphRules,
+    parseMacros,
+    getGlyphGroupsIndex,
+    getGlyphUnicodeProperties,
+    getGuidelineVisibilityTable
+)
+from .compatibility import (
+    getGuidelineLibValue,
+    setGuidelineLibValue,
+    getIdentifier,
+    setGuidelineVisible
+)
 
 numberTextFieldWidth = 50
 noColor = (1.0, 1.0, 1.0, 1.0)
@@ -225,6 +237,8 @@ class GuideToolGuidelineEditor(ezui.TwoColumnForm):
                     guideline = glyph.appendGuideline(
                         guideline=guideline.copy()
                     )
+                    # smart guides are hidden in the model
+                    setGuidelineVisible(guideline, True)
                 self.guideline = guideline
         guideline.name = name
         guideline.x = x
@@ -240,11 +254,27 @@ class GuideToolGuidelineEditor(ezui.TwoColumnForm):
                 # parsed will be an error string
                 pass
             else:
+                # smart guides are hidden in the font and
+                # drawn by the subscriber where their rules
+                # match. hide the guide when it has rules and
+                # show it again when they are removed.
+                oldRules = getGuidelineLibValue(
+                    guideline,
+                    extensionIdentifier + ".rules"
+                )
+                if rules.strip():
+                    if getattr(guideline, "visible", False):
+                        setGuidelineVisible(guideline, False)
+                elif oldRules:
+                    setGuidelineVisible(guideline, True)
                 setGuidelineLibValue(
                     guideline,
                     extensionIdentifier + ".rules",
                     rules
                 )
+                getGuidelineVisibilityTable(font).invalidateGuideline(
+                    getIdentifier(guideline)
+                )
         self.enableRulesEditor()
         postEvent(
             extensionIdentifier + ".guidelineEditedInEditor",
@@ -408,13 +438,8 @@ def getRuleSuggestionMenuItems(font, glyph, callback):
     macros = parseMacros(macros)
     # glyph suggestions
     if glyph is not None:
-        unicodeData = font.asDefcon().unicodeData
         glyphName = glyph.name
-        uni = unicodeData.pseudoUnicodeForGlyphName(glyphName)
-        script = None
-        if uni is not None:
-            script = unicodedata.script(chr(uni))
-        category = unicodeData.categoryForGlyphName(glyphName)
+        uni, script, category = getGlyphUnicodeProperties(font)[glyphName]
         matchedMacros = set()
         for name, rules in macros.items():
             if matchGlyphRules(rules, glyph):
@@ -449,12 +474,12 @@ def getRuleSuggestionMenuItems(font, glyph, callback):
             )
             items.append(item)
         # groups
-        for groupName, contents in sorted(font.groups.items()):
-            if glyphName in contents:
-                item = makeItem(
-                    text=f"group: {groupName}"
-                )
-                items.append(item)
+        groupsIndex = getGlyphGroupsIndex(font)
+        for groupName in sorted(groupsIndex.getGroupsForGlyphName(glyphName)):
+            item = makeItem(
+                text=f"group: {groupName}"
+            )
+            items.append(item)
         # divider
         items.append("---")
     # default suggestions
@@ -0,0 +1,565 @@
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+from fontTools.pens.basePen import BasePen
+from fontTools.misc.bezierTools import segmentPointAtT, solveQuadratic
+
+# ---------
+# Guideline
+# ---------
+
+def normalizeGuidelineGeometry(x, y, angle):
+    """
+    Fill in the values that the UFO spec allows
+    a guideline to omit.
+
+    >>> normalizeGuidelineGeometry(None, 100, None)
+    (0, 100, 0)
+    >>> normalizeGuidelineGeometry(100, None, None)
+    (100, 0, 90)
+    >>> normalizeGuidelineGeometry(10, 20, 45)
+    (10, 20, 45)
+    """
+    if angle is None:
+        if x is None:
+            angle = 0
+        elif y is None:
+            angle = 90
+        else:
+            angle = 0
+    if x is None:
+        x = 0
+    if y is None:
+        y = 0
+    return x, y, angle
+
+def isHorizontalAngle(angle):
+    return angle % 180 == 0
+
+def isVerticalAngle(angle):
+    return angle % 180 == 90
+
+
+class GuidelineLineIndex(object):
+
+    """
+    An array-backed index of guideline lines for
+    analytic hit testing. Horizontal and vertical
+    lines are kept sorted by their position so they
+    can be searched with bisection; all other lines
+    are tested with a point to line distance.
+
+    >>> index = GuidelineLineIndex([
+    ...     (0, 100, 0),
+    ...     (0, 104, 0),
+    ...     (200, 0, 90),
+    ...     (0, 0, 45)
+    ... ])
+    >>> len(index)
+    4
+    >>> index.findNearest((50, 103), 5)
+    (1, 1.0)
+    >>> index.findNearest((198, 500), 5)
+    (2, 2.0)
+    >>> i, d = index.findNearest((300, 302), 5)
+    >>> i, round(d, 3)
+    (3, 1.414)
+    >>> index.findNearest((500, 700), 5)
+    (None, None)
+    >>> index.distanceToLine(0, (50, 90))
+    10.0
+    """
+
+    def __init__(self, lines=()):
+        self.xs = array("d")
+        self.ys = array("d")
+        self.angles = array("d")
+        self.sines = array("d")
+        self.cosines = array("d")
+        horizontal = []
+        vertical = []
+        angled = []
+        for i, (x, y, angle) in enumerate(lines):
+            radians = math.radians(angle)
+            self.xs.append(x)
+            self.ys.append(y)
+            self.angles.append(angle)
+            self.sines.append(math.sin(radians))
+            self.cosines.append(math.cos(radians))
+            if isHorizontalAngle(angle):
+                horizontal.append((y, i))
+            elif isVerticalAngle(angle):
+                vertical.append((x, i))
+            else:
+                angled.append(i)
+        horizontal.sort()
+        vertical.sort()
+        self._horizontalPositions = array("d", [p for p, i in horizontal])
+        self._horizontalIndexes = [i for p, i in horizontal]
+        self._verticalPositions = array("d", [p for p, i in vertical])
+        self._verticalIndexes = [i for p, i in vertical]
+        self._angledIndexes = angled
+
+    def __len__(self):
+        return len(self.xs)
+
+    def distanceToLine(self, i, point):
+        px, py = point
+        return abs(
+            (px - self.xs[i]) * self.sines[i]
+            - (py - self.ys[i]) * self.cosines[i]
+        )
+
+    def findNearest(self, point, tolerance):
+        """
+        Find the line closest to point that is within
+        tolerance. This returns (index, distance) or
+        (None, None) if no line is close enough.
+        """
+        px, py = point
+        found = None
+        foundDistance = None
+        candidates = (
+            (self._horizontalPositions, self._horizontalIndexes, py),
+            (self._verticalPositions, self._verticalIndexes, px),
+        )
+        for positions, indexes, value in candidates:
+            start = bisect_left(positions, value - tolerance)
+            end = bisect_right(positions, value + tolerance)
+            for j in range(start, end):
+                distance = abs(positions[j] - value)
+                if foundDistance is None or distance < foundDistance:
+                    found = indexes[j]
+                    foundDistance = distance
+        for i in self._angledIndexes:
+            distance = self.distanceToLine(i, point)
+            if distance > tolerance:
+                continue
+            if foundDistance is None or distance < foundDistance:
+                found = i
+                foundDistance = distance
+        return found, foundDistance
+
+    def findIntersectingRect(self, rect):
+        """
+        Get the indexes of all lines that pass through
+        rect, given as ((xMin, yMin), (width, height)).
+        Horizontal and vertical lines are found by
+        bisection. Angled lines are clipped against
+        the rectangle in one pass: a line crosses the
+        rectangle when the corners are not all on the
+        same side of it.
+
+        >>> index = GuidelineLineIndex([
+        ...     (0, 100, 0),
+        ...     (0, 300, 0),
+        ...     (200, 0, 90),
+        ...     (0, 0, 45),
+        ...     (0, 1000, 45)
+        ... ])
+        >>> sorted(index.findIntersectingRect(((50, 50), (200, 100))))
+        [0, 2, 3]
+        >>> sorted(index.findIntersectingRect(((500, 0), (10, 10))))
+        []
+        """
+        (xMin, yMin), (w, h) = rect
+        xMax = xMin + w
+        yMax = yMin + h
+        hits = set()
+        candidates = (
+            (self._horizontalPositions, self._horizontalIndexes, yMin, yMax),
+            (self._verticalPositions, self._verticalIndexes, xMin, xMax),
+        )
+        for positions, indexes, low, high in candidates:
+            start = bisect_left(positions, low)
+            end = bisect_right(positions, high)
+            hits.update(indexes[start:end])
+        xs = self.xs
+        ys = self.ys
+        sines = self.sines
+        cosines = self.cosines
+        for i in self._angledIndexes:
+            x = xs[i]
+            y = ys[i]
+            sin = sines[i]
+            cos = cosines[i]
+            dxMin = (xMin - x) * sin
+            dxMax = (xMax - x) * sin
+            dyMin = (yMin - y) * cos
+            dyMax = (yMax - y) * cos
+            d1 = dxMin - dyMin
+            d2 = dxMin - dyMax
+            d3 = dxMax - dyMin
+            d4 = dxMax - dyMax
+            if min(d1, d2, d3, d4) <= 0 <= max(d1, d2, d3, d4):
+                hits.add(i)
+        return hits
+
+
+def findGuidelineCrossings(lines):
+    """
+    Get the points where the given (x, y, angle)
+    lines cross each other. Parallel lines are
+    skipped.
+
+    >>> sorted(findGuidelineCrossings([
+    ...     (0, 100, 0),
+    ...     (0, 200, 0),
+    ...     (200, 0, 90),
+    ...     (0, 0, 45)
+    ... ]))
+    [(100.0, 100.0), (200.0, 100.0), (200.0, 200.0)]
+    """
+    vectors = [
+        (x, y, math.cos(math.radians(angle)), math.sin(math.radians(angle)))
+        for x, y, angle in lines
+    ]
+    crossings = set()
+    for i, (x1, y1, cos1, sin1) in enumerate(vectors):
+        for x2, y2, cos2, sin2 in vectors[i + 1:]:
+            denominator = cos1 * sin2 - sin1 * cos2
+            if abs(denominator) < 1e-9:
+                continue
+            t = ((x2 - x1) * sin2 - (y2 - y1) * cos2) / denominator
+            x = round(x1 + t * cos1, 6) + 0.0
+            y = round(y1 + t * sin1, 6) + 0.0
+            crossings.add((x, y))
+    return crossings
+
+
+# ----------
+# Snap Index
+# ----------
+
+class SnapPointIndex(object):
+
+    """
+    A query structure for snap to points. The points
+    are sorted by x and by y for searching along one
+    axis and bucketed into a grid for searching around
+    a point. Each query returns the set of points that
+    are closest to the given location within padding.
+
+    >>> index = SnapPointIndex([
+    ...     (0, 0),
+    ...     (10, 100),
+    ...     (20, 100),
+    ...     (50, 103),
+    ...     (300, 300),
+    ...     (303, 304)
+    ... ])
+    >>> len(index)
+    6
+    >>> sorted(index.findNearestY(99, 5))
+    [(10, 100), (20, 100)]
+    >>> sorted(index.findNearestY(102, 5))
+    [(50, 103)]
+    >>> sorted(index.findNearestX(48, 5))
+    [(50, 103)]
+    >>> sorted(index.findNearestX(1000, 5))
+    []
+    >>> sorted(index.findNearestPoint((301, 301), 5))
+    [(300, 300)]
+    >>> sorted(index.findNearestPoint((310, 310), 5))
+    []
+    >>> sorted(index.findNearestPoint((1, 1), 100))
+    [(0, 0)]
+    """
+
+    gridSize = 64
+
+    def __init__(self, points=()):
+        self.points = frozenset(points)
+        byX = sorted(self.points)
+        self._xPositions = array("d", [x for x, y in byX])
+        self._xPoints = byX
+        byY = sorted(self.points, key=lambda p: (p[1], p[0]))
+        self._yPositions = array("d", [y for x, y in byY])
+        self._yPoints = byY
+        grid = {}
+        gridSize = self.gridSize
+        for point in self.points:
+            x, y = point
+            cell = (math.floor(x / gridSize), math.floor(y / gridSize))
+            if cell not in grid:
+                grid[cell] = []
+            grid[cell].append(point)
+        self._grid = grid
+
+    def __len__(self):
+        return len(self.points)
+
+    def __iter__(self):
+        return iter(self.points)
+
+    def __contains__(self, point):
+        return point in self.points
+
+    def _findNearestOnAxis(self, positions, points, value, padding):
+        start = bisect_left(positions, value - padding)
+        end = bisect_right(positions, value + padding)
+        hits = set()
+        closest = None
+        for i in range(start, end):
+            distance = abs(positions[i] - value)
+            if closest is None or distance < closest:
+                closest = distance
+                hits = {points[i]}
+            elif distance == closest:
+                hits.add(points[i])
+        return hits
+
+    def findNearestY(self, y, padding):
+        return self._findNearestOnAxis(self._yPositions, self._yPoints, y, padding)
+
+    def findNearestX(self, x, padding):
+        return self._findNearestOnAxis(self._xPositions, self._xPoints, x, padding)
+
+    def findNearestPoint(self, point, padding):
+        x, y = point
+        gridSize = self.gridSize
+        grid = self._grid
+        xMin = math.floor((x - padding) / gridSize)
+        xMax = math.floor((x + padding) / gridSize)
+        yMin = math.floor((y - padding) / gridSize)
+        yMax = math.floor((y + padding) / gridSize)
+        hits = set()
+        closest = None
+        for cx in range(xMin, xMax + 1):
+            for cy in range(yMin, yMax + 1):
+                for candidate in grid.get((cx, cy), ()):
+                    distance = math.hypot(candidate[0] - x, candidate[1] - y)
+                    if distance > padding:
+                        continue
+                    if closest is None or distance < closest:
+                        closest = distance
+                        hits = {candidate}
+                    elif distance == closest:
+                        hits.add(candidate)
+        return hits
+
+    def findNearestOffsets(self, queries, padding):
+        """
+        Query the index for a group of positions in
+        one call. Each query is an (x, y, axis) tuple
+        where axis is "x" for a position that can only
+        move horizontally, "y" for one that can only
+        move vertically and None for one that can move
+        in both directions. The result has one item
+        per query: None if nothing is within padding,
+        otherwise (distance, axis, dx, dy, points) with
+        the offset that moves the position to the points.
+
+        >>> index = SnapPointIndex([(0, 0), (10, 100), (300, 300)])
+        >>> results = index.findNearestOffsets([
+        ...     (50, 98, "y"),
+        ...     (12, 500, "x"),
+        ...     (301, 302, None),
+        ...     (500, 500, None)
+        ... ], 5)
+        >>> results[0]
+        (2.0, 'y', 0, 2, {(10, 100)})
+        >>> results[1]
+        (2.0, 'x', -2, 0, {(10, 100)})
+        >>> results[2][1:]
+        (None, -1, -2, {(300, 300)})
+        >>> results[3] is None
+        True
+        """
+        results = []
+        for x, y, axis in queries:
+            if axis == "y":
+                points = self.findNearestY(y, padding)
+            elif axis == "x":
+                points = self.findNearestX(x, padding)
+            else:
+                points = self.findNearestPoint((x, y), padding)
+            if not points:
+                results.append(None)
+                continue
+            px, py = next(iter(points))
+            if axis == "y":
+                dx = 0
+                dy = py - y
+            elif axis == "x":
+                dx = px - x
+                dy = 0
+            else:
+                dx = px - x
+                dy = py - y
+            distance = math.hypot(dx, dy)
+            results.append((distance, axis, dx, dy, points))
+        return results
+
+
+def chooseGroupOffset(results):
+    """
+    Choose the offset that snaps a group from
+    the results of SnapPointIndex.findNearestOffsets.
+    The nearest horizontal and the nearest vertical
+    snaps are combined, unless a snap that moves in
+    both directions is nearer than either of them.
+    This returns (dx, dy, points, indexes) with the
+    indexes of the results that were used, or None.
+
+    >>> chooseGroupOffset([None, None]) is None
+    True
+    >>> results = [
+    ...     (2.0, "y", 0, 2.0, {(10, 100)}),
+    ...     (1.0, "y", 0, -1.0, {(10, 200)}),
+    ...     (3.0, "x", 3.0, 0, {(20, 0)}),
+    ...     None
+    ... ]
+    >>> dx, dy, points, indexes = chooseGroupOffset(results)
+    >>> dx, dy, sorted(points), indexes
+    (3.0, -1.0, [(10, 200), (20, 0)], [1, 2])
+    >>> results.append((0.5, None, 0.3, 0.4, {(0, 0)}))
+    >>> chooseGroupOffset(results)
+    (0.3, 0.4, {(0, 0)}, [4])
+    """
+    bestX = None
+    bestY = None
+    bestPoint = None
+    for i, result in enumerate(results):
+        if result is None:
+            continue
+        distance, axis, dx, dy, points = result
+        item = (distance, i)
+        if axis == "x":
+            if bestX is None or item < bestX:
+                bestX = item
+        elif axis == "y":
+            if bestY is None or item < bestY:
+                bestY = item
+        elif bestPoint is None or item < bestPoint:
+            bestPoint = item
+    if bestPoint is not None:
+        axisDistances = [best[0] for best in (bestX, bestY) if best is not None]
+        if not axisDistances or bestPoint[0] < min(axisDistances):
+            i = bestPoint[1]
+            distance, axis, dx, dy, points = results[i]
+            return dx, dy, set(points), [i]
+    if bestX is None and bestY is None:
+        return None
+    dx = dy = 0
+    points = set()
+    indexes = []
+    for best in (bestX, bestY):
+        if best is None:
+            continue
+        i = best[1]
+        distance, axis, rdx, rdy, resultPoints = results[i]
+        dx += rdx
+        dy += rdy
+        points |= resultPoints
+        indexes.append(i)
+    return dx, dy, points, sorted(indexes)
+
+
+# --------
+# Segments
+# --------
+
+class ContourSegmentsPen(BasePen):
+
+    """
+    Collect the segments of an outline as tuples of
+    points: two points for a line, three for a
+    quadratic curve and four for a cubic curve.
+    Closing lines are included and zero length
+    lines are dropped. The segments are available
+    as one list and grouped by contour.
+
+    >>> pen = ContourSegmentsPen()
+    >>> pen.moveTo((0, 0))
+    >>> pen.lineTo((0, 100))
+    >>> pen.curveTo((50, 150), (100, 150), (100, 100))
+    >>> pen.lineTo((100, 100))
+    >>> pen.qCurveTo((100, 50), (50, 0))
+    >>> pen.closePath()
+    >>> for segment in pen.segments:
+    ...     segment
+    ((0, 0), (0, 100))
+    ((0, 100), (50, 150), (100, 150), (100, 100))
+    ((100, 100), (100, 50), (50, 0))
+    ((50, 0), (0, 0))
+    >>> len(pen.contours)
+    1
+    """
+
+    def __init__(self):
+        super().__init__(glyphSet=None)
+        self.segments = []
+        self.contours = []
+        self._contourStart = None
+
+    def _addSegment(self, segment):
+        self.segments.append(segment)
+        self.contours[-1].append(segment)
+
+    def _moveTo(self, pt):
+        self._contourStart = pt
+        self.contours.append([])
+
+    def _lineTo(self, pt):
+        start = self._getCurrentPoint()
+        if start != pt:
+            self._addSegment((start, pt))
+
+    def _curveToOne(self, pt1, pt2, pt3):
+        self._addSegment((self._getCurrentPoint(), pt1, pt2, pt3))
+
+    def _qCurveToOne(self, pt1, pt2):
+        self._addSegment((self._getCurrentPoint(), pt1, pt2))
+
+    def _closePath(self):
+        self._lineTo(self._contourStart)
+        self._contourStart = None
+
+    def _endPath(self):
+        self._contourStart = None
+
+
+def findSegmentExtrema(segments):
+    """
+    Get the points where curve segments are
+    horizontal or vertical, not counting the
+    ends of the segments.
+
+    >>> segments = [
+    ...     ((0, 0), (0, 100), (100, 100), (100, 0)),
+    ...     ((100, 0), (150, -50), (200, 0)),
+    ...     ((200, 0), (0, 0))
+    ... ]
+    >>> sorted(findSegmentExtrema(segments))
+    [(50.0, 75.0), (150.0, -25.0)]
+    """
+    extrema = set()
+    for segment in segments:
+        if len(segment) == 2:
+            continue
+        for i in (0, 1):
+            values = [point[i] for point in segment]
+            if len(segment) == 3:
+                v0, v1, v2 = values
+                d0 = v1 - v0
+                d1 = v2 - v1
+                if d0 == d1:
+                    continue
+                ts = [d0 / (d0 - d1)]
+            else:
+                v0, v1, v2, v3 = values
+                d0 = v1 - v0
+                d1 = v2 - v1
+                d2 = v3 - v2
+                ts = solveQuadratic(d0 - 2 * d1 + d2, 2 * (d1 - d0), d0)
+            for t in ts:
+                if 0 < t < 1:
+                    x, y = segmentPointAtT(segment, t)
+                    extrema.add((x, y))
+    return extrema
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,244 @@
+from array import array
+
+# ---------
+# Selection
+# ---------
+#
+# The selected guidelines and the state they had
+# when the current gesture began. The starting
+# x, y and angle are kept in parallel arrays with
+# one slot per guideline. The slots are found by
+# the identity of the guideline's defcon object.
+# Removing a guideline moves the last slot into
+# the hole, so changes are incremental.
+
+axisFree = 0
+axisX = 1
+axisY = 2
+
+class GuidelineSelection:
+
+    """
+    >>> import defcon
+    >>> font = defcon.Font()
+    >>> glyph = font.newGlyph("a")
+    >>> glyph.appendGuideline(dict(x=10, y=0, angle=90))
+    >>> glyph.appendGuideline(dict(x=0, y=20, angle=0))
+    >>> font.appendGuideline(dict(x=5, y=5, angle=45))
+    >>> vertical, horizontal = glyph.guidelines
+    >>> angled = font.guidelines[0]
+
+    >>> selection = GuidelineSelection([vertical, horizontal])
+    >>> len(selection), vertical in selection, angled in selection
+    (2, True, False)
+    >>> selection.add(angled)
+    True
+    >>> selection.add(angled)
+    False
+    >>> selection.getStart(angled)
+    (5.0, 5.0, 45.0)
+
+    Drag deltas are applied along the axis of each guideline.
+
+    >>> selection.getDraggedPositions(3, 4)
+    [(13.0, 0.0), (0.0, 24.0), (8.0, 9.0)]
+
+    Selection changes are incremental.
+
+    >>> added, removed = selection.update([horizontal, angled])
+    >>> added, [guideline.x for guideline in removed]
+    ([], [10])
+    >>> selection.getDraggedPositions(3, 4)
+    [(8.0, 9.0), (0.0, 24.0)]
+    >>> selection.isGlyphGuideline(horizontal), selection.isGlyphGuideline(angled)
+    (True, False)
+    """
+
+    __slots__ = (
+        "guidelines",
+        "slots",
+        "xs",
+        "ys",
+        "angles",
+        "axes",
+        "glyphFlags"
+    )
+
+    def __init__(self, guidelines=()):
+        self.clear()
+        for guideline in guidelines:
+            self.add(guideline)
+
+    def __len__(self):
+        return len(self.guidelines)
+
+    def __bool__(self):
+        return bool(self.guidelines)
+
+    def __iter__(self):
+        return iter(list(self.guidelines))
+
+    def __contains__(self, guideline):
+        return _getIdentity(guideline) in self.slots
+
+    def keys(self):
+        return iter(self)
+
+    def clear(self):
+        self.guidelines = []
+        self.slots = {}
+        self.xs = array("d")
+        self.ys = array("d")
+        self.angles = array("d")
+        self.axes = array("b")
+        self.glyphFlags = array("b")
+
+    def add(self, guideline):
+        """
+        Add a guideline. Return True if it was added.
+        """
+        identity = _getIdentity(guideline)
+        if identity in self.slots:
+            return False
+        self.slots[identity] = len(self.guidelines)
+        self.guidelines.append(guideline)
+        x, y, angle = guideline.x, guideline.y, guideline.angle
+        self.xs.append(x)
+        self.ys.append(y)
+        self.angles.append(angle)
+        self.axes.append(_getAxis(angle))
+        self.glyphFlags.append(_isGlyphGuideline(guideline))
+        return True
+
+    def remove(self, guideline):
+        """
+        Remove a guideline. Return True if it was removed.
+        """
+        slot = self.slots.pop(_getIdentity(guideline), None)
+        if slot is None:
+            return False
+        last = len(self.guidelines) - 1
+        if slot != last:
+            moved = self.guidelines[last]
+            self.guidelines[slot] = moved
+            self.xs[slot] = self.xs[last]
+            self.ys[slot] = self.ys[last]
+            self.angles[slot] = self.angles[last]
+            self.axes[slot] = self.axes[last]
+            self.glyphFlags[slot] = self.glyphFlags[last]
+            self.slots[_getIdentity(moved)] = slot
+        del self.guidelines[last]
+        del self.xs[last]
+        del self.ys[last]
+        del self.angles[last]
+        del self.axes[last]
+        del self.glyphFlags[last]
+        return True
+
+    def set(self, guidelines):
+        """
+        Replace the selection.
+        """
+        self.clear()
+        for guideline in guidelines:
+            self.add(guideline)
+
+    def update(self, guidelines):
+        """
+        Change the selection to the given guidelines
+        and return the (added, removed) guidelines.
+        """
+        wanted = {}
+        for guideline in guidelines:
+            wanted[_getIdentity(guideline)] = guideline
+        removed = [
+            guideline
+            for guideline in self.guidelines
+            if _getIdentity(guideline) not in wanted
+        ]
+        for guideline in removed:
+            self.remove(guideline)
+        added = [
+            guideline
+            for identity, guideline in wanted.items()
+            if identity not in self.slots
+        ]
+        for guideline in added:
+            self.add(guideline)
+        return added, removed
+
+    def refresh(self):
+        """
+        Store the current state of the guidelines
+        as the start of the next gesture.
+
+        >>> import defcon
+        >>> glyph = defcon.Glyph()
+        >>> glyph.appendGuideline(dict(x=10, y=0, angle=90))
+        >>> guideline = glyph.guidelines[0]
+        >>> selection = GuidelineSelection([guideline])
+        >>> guideline.x = 30
+        >>> selection.getStart(guideline)
+        (10.0, 0.0, 90.0)
+        >>> selection.refresh()
+        >>> selection.getStart(guideline)
+        (30.0, 0.0, 90.0)
+        """
+        for slot, guideline in enumerate(self.guidelines):
+            angle = guideline.angle
+            self.xs[slot] = guideline.x
+            self.ys[slot] = guideline.y
+            self.angles[slot] = angle
+            self.axes[slot] = _getAxis(angle)
+
+    def getStart(self, guideline):
+        slot = self.slots[_getIdentity(guideline)]
+        return (self.xs[slot], self.ys[slot], self.angles[slot])
+
+    def isGlyphGuideline(self, guideline):
+        """
+        Get if the guideline belonged to a glyph
+        when it was selected.
+        """
+        slot = self.slots[_getIdentity(guideline)]
+        return bool(self.glyphFlags[slot])
+
+    def getDraggedPositions(self, dx, dy):
+        """
+        Get the (x, y) of all guidelines moved by
+        the delta from their start. Horizontal
+        guidelines only move in y and vertical
+        guidelines only move in x.
+        """
+        moveX = (dx, dx, 0)
+        moveY = (dy, 0, dy)
+        return [
+            (x + moveX[axis], y + moveY[axis])
+            for x, y, axis in zip(self.xs, self.ys, self.axes)
+        ]
+
+    def getAxes(self):
+        """
+        Get the axis each guideline is dragged
+        along as "x", "y" or None.
+        """
+        names = (None, "x", "y")
+        return [names[axis] for axis in self.axes]
+
+
+def _getIdentity(guideline):
+    if hasattr(guideline, "naked"):
+        guideline = guideline.naked()
+    return id(guideline)
+
+def _getAxis(angle):
+    if angle % 180 == 0:
+        return axisY
+    if angle % 180 == 90:
+        return axisX
+    return axisFree
+
+def _isGlyphGuideline(guideline):
+    if hasattr(guideline, "naked"):
+        guideline = guideline.naked()
+    return guideline.glyph is not None
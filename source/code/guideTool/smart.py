@@ -1,5 +1,8 @@
+import re
+import weakref
 import fnmatch
 import defcon
+from defcon.tools import unicodeTools
 from fontTools import unicodedata
 
 # ------
@@ -213,6 +216,662 @@ def parseRules(rules, macros=None):
     )
     return rules
 
+# Compiled Rules
+# --------------
+
+class CompiledRules(object):
+
+    """
+    A rule set compiled for repeated matching.
+    Literal names are stored in a frozenset and
+    wildcard patterns are merged into a single
+    precompiled regular expression.
+
+    >>> rules = CompiledRules(
+    ...     names={"A", "B", "*.sc", "x?"},
+    ...     groups={"group1", "public.kern*"}
+    ... )
+    >>> sorted(rules.literalNames)
+    ['A', 'B']
+    >>> rules.matchName("A")
+    True
+    >>> rules.matchName("a.sc")
+    True
+    >>> rules.matchName("xy")
+    True
+    >>> rules.matchName("C")
+    False
+    >>> rules.matchGroupName("group1")
+    True
+    >>> rules.matchGroupName("public.kern1.A")
+    True
+    >>> rules.matchGroupName("group2")
+    False
+    """
+
+    def __init__(self,
+            matchType="any",
+            names=(),
+            scripts=(),
+            categories=(),
+            groups=()
+        ):
+        self.matchType = matchType
+        self.literalNames, self.namePattern, self.namePatterns = _compilePatterns(names)
+        self.scripts = frozenset(scripts)
+        self.categories = frozenset(categories)
+        self.literalGroups, self.groupPattern, self.groupPatterns = _compilePatterns(groups)
+        self.hasNames = bool(self.literalNames or self.namePatterns)
+        self.hasGroups = bool(self.literalGroups or self.groupPatterns)
+
+    @classmethod
+    def fromParsedRules(cls, rules):
+        return cls(
+            matchType=rules.get("matchType", "any"),
+            names=rules.get("names", ()),
+            scripts=rules.get("scripts", ()),
+            categories=rules.get("categories", ()),
+            groups=rules.get("groups", ())
+        )
+
+    def matchName(self, name):
+        if name in self.literalNames:
+            return True
+        if self.namePattern is not None:
+            return self.namePattern.match(name) is not None
+        return False
+
+    def matchAllNames(self, name):
+        for literal in self.literalNames:
+            if name != literal:
+                return False
+        for pattern in self.namePatterns:
+            if pattern.match(name) is None:
+                return False
+        return True
+
+    def matchGroupName(self, groupName):
+        if groupName in self.literalGroups:
+            return True
+        if self.groupPattern is not None:
+            return self.groupPattern.match(groupName) is not None
+        return False
+
+    def matchGlyph(self, glyph):
+        if not isinstance(glyph, defcon.Glyph):
+            glyph = glyph.asDefcon()
+        font = glyph.font
+        glyphName = glyph.name
+        if self.matchType == "any":
+            if self.hasNames and self.matchName(glyphName):
+                return True
+            if self.scripts or self.categories:
+                uni, script, category = getGlyphUnicodeProperties(font)[glyphName]
+                if script in self.scripts:
+                    return True
+                if category in self.categories:
+                    return True
+            if self.hasGroups:
+                groupsIndex = getGlyphGroupsIndex(font)
+                for groupName in groupsIndex.getGroupsForGlyphName(glyphName):
+                    if self.matchGroupName(groupName):
+                        return True
+            return False
+        else:
+            if not self.scripts or not self.categories:
+                return False
+            if self.hasNames and not self.matchAllNames(glyphName):
+                return False
+            uni, script, category = getGlyphUnicodeProperties(font)[glyphName]
+            if script not in self.scripts:
+                return False
+            if category not in self.categories:
+                return False
+            if self.hasGroups:
+                groupsIndex = getGlyphGroupsIndex(font)
+                glyphGroups = groupsIndex.getGroupsForGlyphName(glyphName)
+                if not groupsIndex.getGroupsMatchingRules(self).issubset(glyphGroups):
+                    return False
+            return True
+
+    def matchGlyphNames(self, font, glyphNames=None):
+        if not isinstance(font, defcon.Font):
+            font = font.asDefcon()
+        if glyphNames is None:
+            glyphNames = font.keys()
+        glyphNames = set(glyphNames)
+        groupsIndex = getGlyphGroupsIndex(font)
+        groups = font.groups
+        if self.matchType == "any":
+            matches = set()
+            if self.hasNames:
+                matches |= self.literalNames & glyphNames
+                if self.namePattern is not None:
+                    pattern = self.namePattern
+                    matches.update(
+                        glyphName
+                        for glyphName in glyphNames
+                        if pattern.match(glyphName) is not None
+                    )
+            if self.hasGroups:
+                for groupName in groupsIndex.getGroupsMatchingRules(self):
+                    matches.update(glyphNames.intersection(groups[groupName]))
+            if self.scripts or self.categories:
+                scripts = self.scripts
+                categories = self.categories
+                properties = getGlyphUnicodeProperties(font)
+                for glyphName in glyphNames - matches:
+                    uni, script, category = properties[glyphName]
+                    if script in scripts or category in categories:
+                        matches.add(glyphName)
+            return matches
+        else:
+            if not self.scripts or not self.categories:
+                return set()
+            matches = glyphNames
+            if self.hasNames:
+                if len(self.literalNames) > 1:
+                    return set()
+                matches = matches & self.literalNames if self.literalNames else set(matches)
+                for pattern in self.namePatterns:
+                    matches = {
+                        glyphName
+                        for glyphName in matches
+                        if pattern.match(glyphName) is not None
+                    }
+            if self.hasGroups:
+                for groupName in groupsIndex.getGroupsMatchingRules(self):
+                    matches = matches.intersection(groups[groupName])
+            scripts = self.scripts
+            categories = self.categories
+            properties = getGlyphUnicodeProperties(font)
+            return {
+                glyphName
+                for glyphName in matches
+                if properties[glyphName][1] in scripts
+                and properties[glyphName][2] in categories
+            }
+
+
+def _compilePatterns(patterns):
+    literals = set()
+    wildcards = []
+    for pattern in sorted(patterns):
+        if _isWildcardPattern(pattern):
+            wildcards.append(pattern)
+        else:
+            literals.add(pattern)
+    merged = None
+    individual = tuple(
+        re.compile(fnmatch.translate(pattern))
+        for pattern in wildcards
+    )
+    if wildcards:
+        merged = re.compile(
+            "|".join(
+                "(?:" + fnmatch.translate(pattern) + ")"
+                for pattern in wildcards
+            )
+        )
+    return frozenset(literals), merged, individual
+
+def _isWildcardPattern(pattern):
+    for c in "*?[":
+        if c in pattern:
+            return True
+    return False
+
+_compiledRulesCache = {}
+_compiledRulesCacheMaximum = 1024
+
+def compileRules(rules, macros=None):
+    """
+    Parse and compile rules text. The compiled rules
+    are cached for each distinct rules text and macros
+    pair. If the rules can't be parsed, the parser's
+    error string will be returned.
+
+    >>> r1 = compileRules("name: A")
+    >>> r2 = compileRules("name: A")
+    >>> r1 is r2
+    True
+    >>> r3 = compileRules("name: A", macros={})
+    >>> r1 is r3
+    False
+    >>> compileRules("xxx")
+    'Invalid syntax: xxx'
+    """
+    key = (rules, _makeMacrosKey(macros))
+    compiled = _compiledRulesCache.get(key)
+    if compiled is None:
+        parsed = parseRules(rules, macros=macros)
+        if isinstance(parsed, str):
+            return parsed
+        compiled = CompiledRules.fromParsedRules(parsed)
+        if len(_compiledRulesCache) >= _compiledRulesCacheMaximum:
+            _compiledRulesCache.clear()
+        _compiledRulesCache[key] = compiled
+    return compiled
+
+def _makeMacrosKey(macros):
+    if macros is None:
+        return None
+    return tuple(
+        (
+            name,
+            tuple(
+                (key, tuple(sorted(value)) if isinstance(value, set) else value)
+                for key, value in sorted(rules.items())
+            )
+        )
+        for name, rules in sorted(macros.items())
+    )
+
+# Unicode Properties
+# ------------------
+
+glyphUnicodePropertiesKey = "com.typesupply.GuideTool.glyphUnicodeProperties"
+
+class GlyphUnicodeProperties(object):
+
+    """
+    A lazily built table of (pseudo-unicode, script, category)
+    for the glyph names in a font. This is stored as a
+    representation of the font's unicode data, so it is
+    discarded whenever glyph names or unicodes change.
+
+    >>> font = _makeTestFont()
+    >>> glyph = font.newGlyph("script.alt")
+    >>> properties = getGlyphUnicodeProperties(font)
+    >>> properties["script"]
+    (65, 'Latn', 'Lu')
+    >>> properties["script.alt"]
+    (65, 'Latn', 'Lu')
+    >>> properties["name"]
+    (None, None, 'Cn')
+    >>> getGlyphUnicodeProperties(font) is properties
+    True
+    >>> font["name"].unicode = ord("a")
+    >>> properties = getGlyphUnicodeProperties(font)
+    >>> properties["name"]
+    (97, 'Latn', 'Ll')
+    >>> font["script"].name = "renamed"
+    >>> properties = getGlyphUnicodeProperties(font)
+    >>> properties["script.alt"]
+    (None, None, 'Cn')
+    """
+
+    def __init__(self, unicodeData):
+        self._unicodeData = weakref.ref(unicodeData)
+        self._properties = {}
+
+    def __getitem__(self, glyphName):
+        properties = self._properties.get(glyphName)
+        if properties is None:
+            uni = self._unicodeData().pseudoUnicodeForGlyphName(glyphName)
+            script = None
+            category = "Cn"
+            if uni is not None:
+                category = unicodeTools.category(uni)
+            if uni:
+                script = unicodedata.script(chr(uni))
+            properties = (uni, script, category)
+            self._properties[glyphName] = properties
+        return properties
+
+
+def glyphUnicodePropertiesRepresentationFactory(unicodeData):
+    return GlyphUnicodeProperties(unicodeData)
+
+defcon.registerRepresentationFactory(
+    defcon.UnicodeData,
+    glyphUnicodePropertiesKey,
+    glyphUnicodePropertiesRepresentationFactory,
+    destructiveNotifications=(
+        "UnicodeData.Changed",
+    )
+)
+
+def getGlyphUnicodeProperties(font):
+    if not isinstance(font, defcon.Font):
+        font = font.asDefcon()
+    return font.unicodeData.getRepresentation(glyphUnicodePropertiesKey)
+
+# Groups Index
+# ------------
+
+glyphGroupsIndexKey = "com.typesupply.GuideTool.glyphGroupsIndex"
+
+class GlyphGroupsIndex(object):
+
+    """
+    A reverse index from glyph names to the
+    names of the groups that contain them.
+
+    >>> font = _makeTestFont()
+    >>> font.groups["group3"] = ["group", "name"]
+    >>> index = getGlyphGroupsIndex(font)
+    >>> sorted(index.getGroupsForGlyphName("group"))
+    ['group1', 'group3']
+    >>> sorted(index.getGroupsForGlyphName("script"))
+    []
+    >>> rules = compileRules("group: group*")
+    >>> sorted(index.getGroupsMatchingRules(rules))
+    ['group1', 'group2', 'group3']
+    >>> getGlyphGroupsIndex(font) is index
+    True
+    >>> font.groups["group4"] = ["script"]
+    >>> index = getGlyphGroupsIndex(font)
+    >>> sorted(index.getGroupsForGlyphName("script"))
+    ['group4']
+    """
+
+    def __init__(self, groups):
+        self.groupNames = frozenset(groups.keys())
+        glyphToGroups = {}
+        for groupName, groupContent in groups.items():
+            for glyphName in groupContent:
+                if glyphName not in glyphToGroups:
+                    glyphToGroups[glyphName] = set()
+                glyphToGroups[glyphName].add(groupName)
+        self._glyphToGroups = {
+            glyphName : frozenset(groupNames)
+            for glyphName, groupNames in glyphToGroups.items()
+        }
+        self._rulesToGroups = {}
+
+    def getGroupsForGlyphName(self, glyphName):
+        return self._glyphToGroups.get(glyphName, frozenset())
+
+    def getChangedGlyphNames(self, other):
+        empty = frozenset()
+        glyphNames = set(self._glyphToGroups) | set(other._glyphToGroups)
+        return {
+            glyphName
+            for glyphName in glyphNames
+            if self._glyphToGroups.get(glyphName, empty) != other._glyphToGroups.get(glyphName, empty)
+        }
+
+    def getGroupsMatchingRules(self, rules):
+        groupNames = self._rulesToGroups.get(rules)
+        if groupNames is None:
+            groupNames = frozenset(
+                groupName
+                for groupName in self.groupNames
+                if rules.matchGroupName(groupName)
+            )
+            self._rulesToGroups[rules] = groupNames
+        return groupNames
+
+
+def glyphGroupsIndexRepresentationFactory(groups):
+    return GlyphGroupsIndex(groups)
+
+defcon.registerRepresentationFactory(
+    defcon.Groups,
+    glyphGroupsIndexKey,
+    glyphGroupsIndexRepresentationFactory,
+    destructiveNotifications=(
+        "Groups.Changed",
+    )
+)
+
+def getGlyphGroupsIndex(font):
+    if not isinstance(font, defcon.Font):
+        font = font.asDefcon()
+    return font.groups.getRepresentation(glyphGroupsIndexKey)
+
+# Visibility Table
+# ----------------
+
+guidelineVisibilityTableKey = "com.typesupply.GuideTool.guidelineVisibilityTable"
+
+class GuidelineVisibilityTable(object):
+
+    """
+    A guideline x glyph table of rule evaluation
+    results for a font. Rows are keyed by guideline
+    identifier and columns by glyph name. Only the
+    affected rows and columns are dropped when glyph
+    names, unicodes, groups, macros or rules change.
+
+    >>> font = _makeTestFont()
+    >>> table = getGuidelineVisibilityTable(font)
+    >>> table.setMacros({})
+    >>> table.isVisible("id1", "name: name", font["name"])
+    True
+    >>> table.isVisible("id1", "name: name", font["script"])
+    False
+    >>> table.getCachedGlyphNames("id1") == {"name", "script"}
+    True
+
+    # rules text change
+    >>> table.isVisible("id1", "name: script", font["script"])
+    True
+    >>> table.getCachedGlyphNames("id1") == {"script"}
+    True
+
+    # glyph name change
+    >>> table.isVisible("id2", "category: Lu", font["category"])
+    True
+    >>> glyph = font.newGlyph("category.alt")
+    >>> table.isVisible("id2", "category: Lu", font["category.alt"])
+    True
+    >>> font["category"].name = "renamed"
+    >>> sorted(table.getCachedGlyphNames("id2"))
+    []
+    >>> table.isVisible("id2", "category: Lu", font["renamed"])
+    True
+
+    # unicode change
+    >>> table.isVisible("id2", "category: Lu", font["name"])
+    False
+    >>> font["name"].unicode = ord("C")
+    >>> sorted(table.getCachedGlyphNames("id2"))
+    ['renamed']
+    >>> table.isVisible("id2", "category: Lu", font["name"])
+    True
+
+    # groups change
+    >>> table.isVisible("id3", "group: group2", font["name"])
+    False
+    >>> table.isVisible("id3", "group: group2", font["group"])
+    False
+    >>> font.groups["group2"] = ["name"]
+    >>> table.isVisible("id3", "group: group2", font["name"])
+    True
+    >>> sorted(table.getCachedGlyphNames("id3"))
+    ['group', 'name']
+
+    # macros change
+    >>> table.setMacros(dict(m=parseRules("name: group")))
+    >>> table.isVisible("id4", "macro: m", font["group"])
+    True
+    >>> table.setMacros(dict(m=parseRules("name: xxx")))
+    >>> table.getCachedGlyphNames("id4")
+    set()
+    >>> sorted(table.getCachedGlyphNames("id3"))
+    ['group', 'name']
+    >>> table.isVisible("id4", "macro: m", font["group"])
+    False
+
+    # invalid rules
+    >>> table.isVisible("id5", "xxx", font["name"]) is None
+    True
+
+    # explicit invalidation
+    >>> table.invalidateGuideline("id3")
+    >>> table.getCachedGlyphNames("id3")
+    set()
+    """
+
+    def __init__(self, font):
+        self._font = weakref.ref(font)
+        self._rows = {}
+        self._macros = None
+        self._macroKeys = {}
+        self._groupsIndex = None
+        self._groupsNeedUpdate = False
+        dispatcher = font.dispatcher
+        if dispatcher is not None:
+            dispatcher.addObserver(
+                observer=self,
+                methodName="_glyphNameChanged",
+                notification="Glyph.NameChanged"
+            )
+            dispatcher.addObserver(
+                observer=self,
+                methodName="_glyphUnicodesChanged",
+                notification="Glyph.UnicodesChanged"
+            )
+            for notification in ("Layer.GlyphAdded", "Layer.GlyphDeleted"):
+                dispatcher.addObserver(
+                    observer=self,
+                    methodName="_layerGlyphsChanged",
+                    notification=notification
+                )
+            dispatcher.addObserver(
+                observer=self,
+                methodName="_groupsChanged",
+                notification="Groups.Changed",
+                observable=font.groups
+            )
+
+    # Lookup
+
+    def isVisible(self, identifier, rules, glyph):
+        font = self._font()
+        glyphName = glyph.name
+        if self._groupsNeedUpdate:
+            self._updateGroups()
+        elif self._groupsIndex is None:
+            self._groupsIndex = getGlyphGroupsIndex(font)
+        row = self._rows.get(identifier)
+        if row is None or row.rules != rules:
+            compiled = compileRules(rules, macros=self._macros)
+            row = _GuidelineVisibilityRow(rules, compiled)
+            self._rows[identifier] = row
+        if isinstance(row.compiled, str):
+            return None
+        values = row.values
+        visible = values.get(glyphName)
+        if visible is None:
+            visible = row.compiled.matchGlyph(glyph)
+            values[glyphName] = visible
+        return visible
+
+    def getCachedGlyphNames(self, identifier):
+        row = self._rows.get(identifier)
+        if row is None:
+            return set()
+        return set(row.values.keys())
+
+    # Invalidation
+
+    def setMacros(self, macros):
+        if macros is self._macros:
+            return
+        macroKeys = {
+            name : _makeMacrosKey({name : rules})
+            for name, rules in macros.items()
+        }
+        changed = {
+            name
+            for name in set(macroKeys) | set(self._macroKeys)
+            if macroKeys.get(name) != self._macroKeys.get(name)
+        }
+        self._macros = macros
+        self._macroKeys = macroKeys
+        for identifier, row in list(self._rows.items()):
+            if row.macroNames & changed:
+                del self._rows[identifier]
+
+    def invalidateGuideline(self, identifier):
+        self._rows.pop(identifier, None)
+
+    def invalidateGlyphNames(self, glyphNames):
+        glyphNames = set(glyphNames)
+        for row in self._rows.values():
+            values = row.values
+            for glyphName in list(values.keys()):
+                if glyphName in glyphNames:
+                    del values[glyphName]
+                elif _getPseudoUnicodeBase(glyphName) in glyphNames:
+                    del values[glyphName]
+
+    def _updateGroups(self):
+        self._groupsNeedUpdate = False
+        oldIndex = self._groupsIndex
+        newIndex = getGlyphGroupsIndex(self._font())
+        self._groupsIndex = newIndex
+        if oldIndex is None:
+            return
+        if oldIndex.groupNames != newIndex.groupNames:
+            for identifier, row in list(self._rows.items()):
+                compiled = row.compiled
+                if isinstance(compiled, str):
+                    continue
+                if compiled.hasGroups and compiled.matchType == "all":
+                    del self._rows[identifier]
+        self.invalidateGlyphNames(newIndex.getChangedGlyphNames(oldIndex))
+
+    # Notifications
+
+    def _glyphNameChanged(self, notification):
+        data = notification.data
+        self.invalidateGlyphNames((data["oldValue"], data["newValue"]))
+
+    def _glyphUnicodesChanged(self, notification):
+        self.invalidateGlyphNames((notification.object.name,))
+
+    def _layerGlyphsChanged(self, notification):
+        self.invalidateGlyphNames((notification.data["name"],))
+
+    def _groupsChanged(self, notification):
+        self._groupsNeedUpdate = True
+
+
+class _GuidelineVisibilityRow(object):
+
+    def __init__(self, rules, compiled):
+        self.rules = rules
+        self.compiled = compiled
+        self.macroNames = _getMacroNames(rules)
+        self.values = {}
+
+
+def _getMacroNames(rules):
+    names = set()
+    for line in rules.splitlines():
+        line = line.split("#")[0].strip()
+        if ":" not in line:
+            continue
+        tag, content = line.split(":", 1)
+        if tag.strip() == "macro":
+            names.add(content.strip())
+    return names
+
+def _getPseudoUnicodeBase(glyphName):
+    return glyphName.split(".")[0].split("_")[0]
+
+def guidelineVisibilityTableRepresentationFactory(font):
+    return GuidelineVisibilityTable(font)
+
+defcon.registerRepresentationFactory(
+    defcon.Font,
+    guidelineVisibilityTableKey,
+    guidelineVisibilityTableRepresentationFactory,
+    destructiveNotifications=()
+)
+
+def getGuidelineVisibilityTable(font):
+    if not isinstance(font, defcon.Font):
+        font = font.asDefcon()
+    return font.getRepresentation(guidelineVisibilityTableKey)
+
+# Matching
+# --------
+
 def matchGlyphRules(rules, glyph):
     """
     >>> font = _makeTestFont()
@@ -280,54 +939,53 @@ def matchGlyphRules(rules, glyph):
     ... )
     >>> matchGlyphRules(rules, font["group"])
     False
+
+    # compiled
+    >>> rules = compileRules("name: name")
+    >>> matchGlyphRules(rules, font["name"])
+    True
     """
-    if not isinstance(glyph, defcon.Glyph):
-        glyph = glyph.asDefcon()
-    font = glyph.font
-    unicodeData = font.unicodeData
-    matchType = rules.get("matchType", "any")
-    # Names
-    for namePattern in rules.get("names", []):
-        if matchPattern(glyph.name, namePattern):
-            if matchType == "any":
-                return True
-        else:
-            if matchType == "all":
-                return False
-    # Scripts
-    uni = unicodeData.pseudoUnicodeForGlyphName(glyph.name)
-    script = None
-    if uni:
-        script = unicodedata.script(chr(uni))
-    if script in rules.get("scripts", []):
-        if matchType == "any":
-            return True
-    else:
-        if matchType == "all":
-            return False
-    # Categories
-    category = unicodeData.categoryForGlyphName(glyph.name)
-    if category in rules.get("categories", []):
-        if matchType == "any":
-            return True
-    else:
-        if matchType == "all":
-            return False
-    # Groups
-    for groupPattern in rules.get("groups", []):
-        for groupName, groupContent in font.groups.items():
-            if matchPattern(groupName, groupPattern):
-                if glyph.name in groupContent:
-                    if matchType == "any":
-                        return True
-                else:
-                    if matchType == "all":
-                        return False
-    # Nothing
-    if matchType == "any":
-        return False
-    else:
-        return True
+    if not isinstance(rules, CompiledRules):
+        rules = CompiledRules.fromParsedRules(rules)
+    return rules.matchGlyph(glyph)
+
+def matchFontRules(rules, font, glyphNames=None):
+    """
+    Get the names of all glyphs in font, or in glyphNames
+    if given, that match rules. The unicode properties and
+    group memberships are determined once for all glyphs.
+
+    >>> font = _makeTestFont()
+    >>> rules = compileRules(
+    ...     '''
+    ...     name: name
+    ...     category: Lu
+    ...     '''
+    ... )
+    >>> sorted(matchFontRules(rules, font))
+    ['category', 'name', 'script']
+    >>> sorted(matchFontRules(rules, font, ["name", "group"]))
+    ['name']
+    >>> rules = compileRules("group: group*")
+    >>> sorted(matchFontRules(rules, font))
+    ['group']
+    >>> rules = dict(
+    ...     matchType="all",
+    ...     names={"script"},
+    ...     scripts={"Latn"},
+    ...     categories={"Lu"}
+    ... )
+    >>> sorted(matchFontRules(rules, font))
+    ['script']
+    >>> all(
+    ...     (glyph.name in matchFontRules(rules, font)) == matchGlyphRules(rules, glyph)
+    ...     for glyph in font
+    ... )
+    True
+    """
+    if not isinstance(rules, CompiledRules):
+        rules = CompiledRules.fromParsedRules(rules)
+    return rules.matchGlyphNames(font, glyphNames)
 
 def matchPattern(string, pattern):
     """
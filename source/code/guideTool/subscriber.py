@@ -1,31 +1,75 @@
+import weakref
+import AppKit
 from mojo.subscriber import Subscriber, registerGlyphEditorSubscriber
 from mojo.extensions import getExtensionDefault
 from mojo.events import addObserver, removeObserver
+from mojo.tools import CallbackWrapper
+from mojo.UI import getDefault
 from .defaults import extensionIdentifier
-from .smart import parseRules, matchGlyphRules, parseMacros
-from .compatibility import getGuidelineLibValue
+from .smart import parseMacros, getGuidelineVisibilityTable
+from .compatibility import (
+    getGuidelineLibValue,
+    getIdentifier,
+    setGuidelineVisible,
+    holdGuidelineNotifications
+)
+from .tool import getGuidelinePathPoints, FrameTimer
+
+migratedFonts = weakref.WeakSet()
 
 class GuideToolSubscriber(Subscriber):
 
     debug = False
 
+    toggleDelay = 0
+    toggleTimer = None
+    toggleTimerTarget = None
+    observedFont = None
+    frameTimer = None
+
     def build(self):
+        glyphEditor = self.getGlyphEditor()
+        self.smartGuidelinesContainer = glyphEditor.extensionContainer(
+            identifier=extensionIdentifier + ".smartGuidelines",
+            location="background",
+            clear=True
+        )
+        self.visibilityMask = {}
         self.loadDefaults()
         addObserver(
             self,
             "extensionDefaultsChanged",
             extensionIdentifier + ".defaultsChanged"
         )
+        addObserver(
+            self,
+            "guidelineEditedInEditor",
+            extensionIdentifier + ".guidelineEditedInEditor"
+        )
 
     def destroy(self):
+        self.cancelScheduledToggleGuidelines()
+        self.cancelFrameUpdate()
+        self.setObservedFont(None)
+        self.smartGuidelinesContainer.clearSublayers()
+        self.smartGuidelineLayers = {}
         removeObserver(
             self,
             extensionIdentifier + ".defaultsChanged"
         )
+        removeObserver(
+            self,
+            extensionIdentifier + ".guidelineEditedInEditor"
+        )
 
     def loadDefaults(self):
         macros = getExtensionDefault(extensionIdentifier + ".smartMacros")
         self.macros = parseMacros(macros)
+        self.toggleDelay = getExtensionDefault(extensionIdentifier + ".smartGuideDelay")
+        self.colorFontGuideline = getDefault("glyphViewGlobalGuidesColor")
+        self.guidelineStrokeWidth = getDefault("glyphViewStrokeWidth")
+        self.smartGuidelinesContainer.clearSublayers()
+        self.smartGuidelineLayers = {}
         self.toggleGuidelines()
 
     def roboFontDidChangePreferences(self, info):
@@ -34,31 +78,198 @@ class GuideToolSubscriber(Subscriber):
     def extensionDefaultsChanged(self, event):
         self.loadDefaults()
 
+    def guidelineEditedInEditor(self, event):
+        self.toggleGuidelines()
+
     def glyphEditorDidSetGlyph(self, info):
+        self.scheduleToggleGuidelines()
+
+    # Font Observation
+
+    def setObservedFont(self, font):
+        if font is not None:
+            font = font.asDefcon()
+        if font is self.observedFont:
+            return
+        if self.observedFont is not None:
+            self.observedFont.removeObserver(self, "Font.GuidelinesChanged")
+        self.observedFont = font
+        if font is not None:
+            font.addObserver(self, "fontGuidelinesChanged", "Font.GuidelinesChanged")
+
+    def fontGuidelinesChanged(self, notification):
+        self.scheduleFrameUpdate()
+
+    # Coalescing
+    # ----------
+    # Browsing glyphs quickly (holding an arrow key)
+    # sets many glyphs in a short time. Only the glyph
+    # that is current once things settle down for the
+    # delay is evaluated. The timer fires on the main
+    # thread and is cancelled if the glyph changes again.
+
+    def scheduleToggleGuidelines(self):
+        self.cancelScheduledToggleGuidelines()
+        if not self.toggleDelay:
+            self.toggleGuidelines()
+            return
+        self.toggleTimerTarget = CallbackWrapper(self.toggleTimerFired)
+        self.toggleTimer = AppKit.NSTimer.scheduledTimerWithTimeInterval_target_selector_userInfo_repeats_(
+            self.toggleDelay,
+            self.toggleTimerTarget,
+            "action:",
+            None,
+            False
+        )
+
+    def cancelScheduledToggleGuidelines(self):
+        if self.toggleTimer is not None:
+            self.toggleTimer.invalidate()
+        self.toggleTimer = None
+        self.toggleTimerTarget = None
+
+    def toggleTimerFired(self, timer):
+        self.toggleTimer = None
+        self.toggleTimerTarget = None
         self.toggleGuidelines()
 
+    # Font guideline changes arrive once per guideline
+    # while guides are dragged or nudged. They are
+    # collected into one update on the next frame.
+
+    def scheduleFrameUpdate(self):
+        if self.frameTimer is None:
+            self.frameTimer = FrameTimer(self.frameUpdateFired)
+
+    def cancelFrameUpdate(self):
+        if self.frameTimer is not None:
+            self.frameTimer.stop()
+        self.frameTimer = None
+
+    def frameUpdateFired(self):
+        self.frameTimer = None
+        self.toggleGuidelines()
+        return False
+
+    # Visibility
+    # ----------
+    # Smart guides are shown per glyph editor. The
+    # rules are evaluated into a mask that belongs
+    # to this editor and the guides that pass are
+    # drawn in this editor only. A smart guide is a
+    # font guideline with rules. It is hidden in the
+    # font and drawn here when its rules match the
+    # glyph. The model is not written to, apart from
+    # a migration the first time a font is seen:
+    # earlier versions wrote the visibility for the
+    # current glyph to the font guidelines, so guides
+    # with rules were left visible or hidden depending
+    # on the glyph that was viewed last. Those that
+    # are visible are hidden once.
+
     def toggleGuidelines(self):
         editor = self.getGlyphEditor()
         glyph = editor.getGlyph()
         if glyph is None:
+            self.setObservedFont(None)
+            self.visibilityMask = {}
+            self.displaySmartGuidelines(None)
             return
         font = glyph.font
+        self.setObservedFont(font)
+        visibilityTable = getGuidelineVisibilityTable(font)
+        visibilityTable.setMacros(self.macros)
+        visibilityMask = {}
+        migrate = font.naked() not in migratedFonts
+        hide = []
         for guideline in font.guidelines:
             rules = getGuidelineLibValue(guideline, extensionIdentifier + ".rules")
             if not rules:
                 continue
-            rules = parseRules(
+            if migrate and getattr(guideline, "visible", False):
+                hide.append(guideline)
+            identifier = getIdentifier(guideline)
+            visible = visibilityTable.isVisible(
+                identifier,
                 rules,
-                macros=self.macros
+                glyph
             )
-            try:
-                guideline.visible = matchGlyphRules(rules, glyph)
-            except AttributeError:
-                pass
+            if visible is None:
+                continue
+            visibilityMask[identifier] = visible
+        self.visibilityMask = visibilityMask
+        if migrate:
+            migratedFonts.add(font.naked())
+            if hide:
+                with holdGuidelineNotifications(hide, note="Guide Tool smart guide migration"):
+                    for guideline in hide:
+                        setGuidelineVisible(guideline, False)
+        self.displaySmartGuidelines(font)
 
+    # The layers are kept by guideline identifier.
+    # When the same guides are shown with the same
+    # name and color, as while they are dragged, the
+    # layers are only moved. Otherwise they are built
+    # again.
+
+    def displaySmartGuidelines(self, font):
+        shown = []
+        if font is not None and self.visibilityMask:
+            for guideline in font.guidelines:
+                identifier = guideline.naked().identifier
+                if not self.visibilityMask.get(identifier):
+                    continue
+                color = guideline.color
+                if color is None:
+                    color = self.colorFontGuideline
+                shown.append((identifier, guideline, color))
+        layers = self.smartGuidelineLayers
+        container = self.smartGuidelinesContainer
+        canMove = (
+            len(shown) == len(layers)
+            and all(
+                identifier in layers
+                and layers[identifier][0] == (guideline.name, color)
+                for identifier, guideline, color in shown
+            )
+        )
+        with container.sublayerGroup():
+            if canMove:
+                for identifier, guideline, color in shown:
+                    values, lineLayer, textLayer = layers[identifier]
+                    startPoint, endPoint = getGuidelinePathPoints(guideline)
+                    position = (guideline.x, guideline.y)
+                    lineLayer.setPosition(position)
+                    lineLayer.setStartPoint(startPoint)
+                    lineLayer.setEndPoint(endPoint)
+                    if textLayer is not None:
+                        textLayer.setPosition(position)
+                return
+            container.clearSublayers()
+            layers.clear()
+            for identifier, guideline, color in shown:
+                startPoint, endPoint = getGuidelinePathPoints(guideline)
+                position = (guideline.x, guideline.y)
+                lineLayer = container.appendLineSublayer(
+                    position=position,
+                    startPoint=startPoint,
+                    endPoint=endPoint,
+                    strokeColor=color,
+                    strokeWidth=self.guidelineStrokeWidth
+                )
+                textLayer = None
+                if guideline.name:
+                    textLayer = container.appendTextLineSublayer(
+                        position=position,
+                        text=guideline.name,
+                        fillColor=color,
+                        pointSize=10,
+                        horizontalAlignment="left"
+                    )
+                layers[identifier] = ((guideline.name, color), lineLayer, textLayer)
 
 def main():
     registerGlyphEditorSubscriber(GuideToolSubscriber)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
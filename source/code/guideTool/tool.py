@@ -1,15 +1,39 @@
 import math
-from collections import namedtuple
+import weakref
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import AppKit
 import defcon
+import merz
+from fontTools.pens.recordingPen import RecordingPen
 from booleanOperations.booleanGlyph import BooleanGlyph
+from PyObjCTools.AppHelper import callAfter
 from lib.tools import bezierTools
 from mojo.events import installTool, BaseEventTool, extractNSEvent, addObserver
 from mojo.UI import getDefault
 from mojo.extensions import getExtensionDefault
+from mojo.tools import CallbackWrapper
 from .editor import GuidelineEditorController
 from .images import guideToolToolbarIcon, guideToolCursor
 from .defaults import extensionIdentifier
+from .compatibility import (
+    setGuidelineVisible,
+    holdGuidelineNotifications,
+    holdGuidelineParentNotifications
+)
+from .undo import GuidelineUndoGroup
+from .selection import GuidelineSelection
+from .geometry import (
+    GuidelineLineIndex,
+    SnapPointIndex,
+    chooseGroupOffset,
+    ContourSegmentsPen,
+    findSegmentExtrema,
+    findGuidelineCrossings,
+    normalizeGuidelineGeometry,
+    isHorizontalAngle,
+    isVerticalAngle
+)
 
 
 deleteKeys = [
@@ -19,28 +43,45 @@ deleteKeys = [
     chr(0x007F),
 ]
 
-horizontalAngles = (0, 180)
-verticalAngles = (90, 270)
-rightAngles = horizontalAngles + verticalAngles
-
 
 class GuidelineTool(BaseEventTool):
 
-    selectedGuidelines = {}
+    selectedGuidelines = None
     selectedGuidelineLayers = {}
+    selectedGuidelineLayerValues = {}
+    guidelineHighlightColors = {}
+    mergedHighlightLayers = {}
+    mergedHighlightBase = None
+    mergedSnapToPointsLayer = None
+    mergedSnapToPoints = frozenset()
+    mergedSnapToPointsScale = None
     inRectSelection = False
     isDraggingGuidelines = False
     mouseDownPoint = None
     snappingToThesePoints = []
     snapToPointSymbolColor = None
-    mouseSequenceUndoCoalescing = None
+    snapToPointImageSettings = None
+    undoGroup = None
+    nudgeDelta = None
+    nudgeUndoGroup = None
+    nudgeTimer = None
+    dragTimer = None
+    pendingDragPoint = None
+    futurePointsJob = None
 
     wantItalicAngle = True
-    wantsSnapToPoint = True
-    wantsSnapToFuturePoints = True
+    snapSourceNames = ()
+    snapToPoints = None
+    pendingSnapSources = ()
     highlightAlphaScale = 0.15
+    mergedRenderingThreshold = 40
 
     def setup(self):
+        self.selectedGuidelines = GuidelineSelection()
+        self.selectedGuidelineLayerValues = {}
+        self.mergedHighlightLayers = {}
+        self.snapToPointSymbolLayers = {}
+        self.guidelineRegistry = GuidelineRegistry()
         self.loadDefaults()
         container = self.extensionContainer(
             identifier=extensionIdentifier + ".background",
@@ -84,11 +125,17 @@ class GuidelineTool(BaseEventTool):
             pointCount=10,
             inner=0.2
         )
+        self.snapToPointImageSettings = None
         self.wantItalicAngle = getExtensionDefault(extensionIdentifier + ".wantItalicAngle")
-        self.wantsSnapToPoint = getExtensionDefault(extensionIdentifier + ".snapToPoint")
-        self.wantsSnapToFuturePoints = getExtensionDefault(extensionIdentifier + ".snapToFuturePoint")
+        self.snapSourceNames = [
+            name
+            for name, (defaultKey, function) in snapSources.items()
+            if getExtensionDefault(extensionIdentifier + "." + defaultKey)
+        ]
+        self.snapToPoints = None
         self.wantsHapticFeedbackOnSnapTo = getExtensionDefault(extensionIdentifier + ".hapticFeedbackOnSnapTo")
         self.highlightAlphaScale = getExtensionDefault(extensionIdentifier + ".highlightAlphaScale")
+        self.guidelineHighlightColors = {}
 
     def getToolbarIcon(self):
         return guideToolToolbarIcon
@@ -99,76 +146,192 @@ class GuidelineTool(BaseEventTool):
     def preferencesChanged(self):
         self.loadDefaults()
         self.marqueeLayer.setFillColor(self.colorMarquee)
+        self.updateSelectedGuidelineColors()
 
     def extensionDefaultsChanged(self, event):
         self.loadDefaults()
         self.updateSelectedGuidelineColors()
 
     def currentGlyphChanged(self):
+        self.finishNudge()
         self.deselectAll()
+        self.guidelineHighlightColors = {}
+        self.snapToPoints = None
+        self.prewarmSnapToPoints()
 
     def didUndo(self, notification):
-        glyph = self.getGlyph()
-        font = glyph.font
-        glyphGuidelines = glyph.guidelines
-        fontGuidelines = font.guidelines
+        registry = self.getGuidelineRegistry()
         remove = []
-        for guideline in self.selectedGuidelines.keys():
-            if guideline in glyphGuidelines:
-                continue
-            if guideline in fontGuidelines:
+        for guideline in self.selectedGuidelines:
+            if registry.contains(guideline):
                 continue
             remove.append(guideline)
         for guideline in remove:
-            del self.selectedGuidelines[guideline]
+            self.selectedGuidelines.remove(guideline)
+        self.selectedGuidelines.refresh()
+        self.guidelineHighlightColors = {}
         self.displaySelectedGuidelines()
 
+    def getGuidelineRegistry(self):
+        registry = self.guidelineRegistry
+        registry.setGlyph(self.getGlyph())
+        return registry
+
+    def getUndoManager(self):
+        return self.getNSView().undoManager()
+
+    def guidelinesUndone(self):
+        if self.getGlyph() is None:
+            return
+        self.didUndo(None)
+
     def becomeActive(self):
-        pass
+        self.prewarmSnapToPoints()
 
     def becomeInactive(self):
+        self.stopDragTimer()
+        self.pendingDragPoint = None
+        self.finishNudge()
         self.deselectAll()
+        self.guidelineRegistry.setGlyph(None)
+        self.futurePointsJob = None
 
     # Display
 
     def displaySnapToPoints(self):
         container = self.snapToPointsLayer
-        if not self.snappingToThesePoints:
+        if len(self.snappingToThesePoints) > self.mergedRenderingThreshold:
+            self.displayMergedSnapToPoints()
+            return
+        if self.mergedSnapToPointsLayer is not None:
+            container.removeSublayer(self.mergedSnapToPointsLayer)
+            self.mergedSnapToPointsLayer = None
+            self.mergedSnapToPoints = frozenset()
+        symbolLayers = self.snapToPointSymbolLayers
+        points = set(self.snappingToThesePoints)
+        if not points:
+            if symbolLayers:
+                container.clearSublayers()
+                symbolLayers.clear()
+            return
+        needed = points.difference(symbolLayers)
+        remove = symbolLayers.keys() - points
+        if needed or remove:
+            imageSettings = self.getSnapToPointImageSettings()
+            with container.sublayerGroup():
+                for point in remove:
+                    container.removeSublayer(symbolLayers.pop(point))
+                for point in needed:
+                    symbolLayers[point] = container.appendSymbolSublayer(
+                        position=point,
+                        imageSettings=imageSettings
+                    )
+        if needed:
+            self.performSnapToHapticFeedback()
+
+    def getSnapToPointImageSettings(self):
+        imageSettings = self.snapToPointImageSettings
+        color = self.snapToPointSymbolColor
+        if imageSettings is None or imageSettings["fillColor"] != color:
+            imageSettings = dict(self.snapToPointSymbolSettings)
+            imageSettings["fillColor"] = color
+            self.snapToPointImageSettings = imageSettings
+        return imageSettings
+
+    def displayMergedSnapToPoints(self):
+        """
+        Draw all snap to point symbols as stars
+        in one path layer. The symbol size is in
+        screen points, so the stars are scaled to
+        the zoom of the view and drawn again when
+        it changes.
+        """
+        container = self.snapToPointsLayer
+        points = frozenset(self.snappingToThesePoints)
+        if self.mergedSnapToPointsLayer is None:
             container.clearSublayers()
-        else:
-            imageSettings = self.snapToPointSymbolSettings
-            imageSettings["size"] = (self.snapToPointSymbolSize, self.snapToPointSymbolSize)
-            imageSettings["fillColor"] = self.snapToPointSymbolColor
-            needed = list(self.snappingToThesePoints)
-            remove = []
-            for symbol in container.getSublayers():
-                point = symbol.getPosition()
-                if point in needed:
-                    needed.remove(point)
+            self.snapToPointSymbolLayers.clear()
+            self.mergedSnapToPointsLayer = container.appendPathSublayer(
+                name="mergedSnapIndicator"
+            )
+            self.mergedSnapToPoints = frozenset()
+        scale = self.getNSView().inverseScale()
+        if points == self.mergedSnapToPoints and scale == self.mergedSnapToPointsScale:
+            return
+        needed = points - self.mergedSnapToPoints
+        star = getStarPolygon(
+            self.snapToPointSymbolSize * scale,
+            self.snapToPointSymbolSettings["pointCount"],
+            self.snapToPointSymbolSettings["inner"]
+        )
+        pen = merz.MerzPen()
+        for x, y in points:
+            for i, (dx, dy) in enumerate(star):
+                if i == 0:
+                    pen.moveTo((x + dx, y + dy))
                 else:
-                    remove.append(symbol)
-            if needed or remove:
-                with container.sublayerGroup():
-                    for point in needed:
-                        container.appendSymbolSublayer(
-                            position=point,
-                            imageSettings=imageSettings
-                        )
-                    for symbol in remove:
-                        container.removeSublayer(symbol)
-            if needed and self.wantsHapticFeedbackOnSnapTo:
-                performer = AppKit.NSHapticFeedbackManager.defaultPerformer()
-                performer.performFeedbackPattern_performanceTime_(
-                    AppKit.NSHapticFeedbackPatternAlignment,
-                    AppKit.NSHapticFeedbackPerformanceTimeDefault
-                )
+                    pen.lineTo((x + dx, y + dy))
+            pen.closePath()
+        layer = self.mergedSnapToPointsLayer
+        with layer.propertyGroup():
+            layer.setPath(pen.path)
+            layer.setFillColor(self.snapToPointSymbolColor)
+        self.mergedSnapToPoints = points
+        self.mergedSnapToPointsScale = scale
+        if needed:
+            self.performSnapToHapticFeedback()
+
+    def performSnapToHapticFeedback(self):
+        if not self.wantsHapticFeedbackOnSnapTo:
+            return
+        performer = AppKit.NSHapticFeedbackManager.defaultPerformer()
+        performer.performFeedbackPattern_performanceTime_(
+            AppKit.NSHapticFeedbackPatternAlignment,
+            AppKit.NSHapticFeedbackPerformanceTimeDefault
+        )
 
-    def displaySelectedGuidelines(self):
+    def displaySelectedGuidelines(self, selectionDiff=None):
+        """
+        selectionDiff may be an (added, removed) tuple
+        when only the selection changed. Only those
+        guidelines will be updated.
+        """
         container = self.selectionIndicatorLayer
         # clear all
         if not self.selectedGuidelines:
             container.clearSublayers()
             self.selectedGuidelineLayers = {}
+            self.selectedGuidelineLayerValues = {}
+            self.mergedHighlightLayers = {}
+            self.mergedHighlightBase = None
+            return
+        # merged
+        if len(self.selectedGuidelines) > self.mergedRenderingThreshold:
+            self.displayMergedSelectedGuidelines()
+            return
+        if self.mergedHighlightLayers:
+            with container.sublayerGroup():
+                for layer in self.mergedHighlightLayers.values():
+                    container.removeSublayer(layer)
+            self.mergedHighlightLayers = {}
+            self.mergedHighlightBase = None
+            selectionDiff = None
+        # incremental
+        if selectionDiff is not None:
+            added, removed = selectionDiff
+            remove = [
+                guideline
+                for guideline in removed
+                if guideline in self.selectedGuidelineLayers
+            ]
+            if remove:
+                with container.sublayerGroup():
+                    for guideline in remove:
+                        self.removeSelectedGuidelineLayer(guideline)
+            if added:
+                with container.sublayerGroup():
+                    for guideline in added:
+                        self.appendSelectedGuidelineLayer(guideline)
             return
         # clear subset
         remove = [
@@ -179,58 +342,188 @@ class GuidelineTool(BaseEventTool):
         if remove:
             with container.sublayerGroup():
                 for guideline in remove:
-                    layer = self.selectedGuidelineLayers.pop(guideline)
-                    container.removeSublayer(layer)
+                    self.removeSelectedGuidelineLayer(guideline)
         add = []
-        for guideline in self.selectedGuidelines.keys():
+        for guideline in self.selectedGuidelines:
             if guideline in self.selectedGuidelineLayers:
-                layer = self.selectedGuidelineLayers[guideline]
-                with layer.propertyGroup():
-                    startPoint, endPoint = getGuidelinePathPoints(guideline)
-                    color = getGuidelineHighlightColor(
-                        guideline,
-                        self.colorFontGuideline,
-                        self.colorGlyphGuideline,
-                        self.highlightAlphaScale
-                    )
-                    layer.setStartPoint(startPoint)
-                    layer.setEndPoint(endPoint)
-                    layer.setStrokeColor(color)
-                    layer.setPosition((guideline.x, guideline.y))
+                self.updateSelectedGuidelineLayer(guideline)
             else:
                 add.append(guideline)
         if add:
             with container.sublayerGroup():
                 for guideline in add:
-                    startPoint, endPoint = getGuidelinePathPoints(guideline)
-                    color = getGuidelineHighlightColor(
-                        guideline,
-                        self.colorFontGuideline,
-                        self.colorGlyphGuideline,
-                        self.highlightAlphaScale
-                    )
-                    self.selectedGuidelineLayers[guideline] = container.appendLineSublayer(
-                        position=(guideline.x, guideline.y),
-                        startPoint=startPoint,
-                        endPoint=endPoint,
+                    self.appendSelectedGuidelineLayer(guideline)
+
+    def displayMergedSelectedGuidelines(self):
+        """
+        Draw the highlights of all selected guidelines
+        with one path layer per color instead of one
+        line layer per guideline. When the guidelines
+        have only been moved together, as in a drag,
+        the layers are shifted instead of drawn again.
+        """
+        container = self.selectionIndicatorLayer
+        if self.selectedGuidelineLayers:
+            with container.sublayerGroup():
+                for guideline in list(self.selectedGuidelineLayers.keys()):
+                    self.removeSelectedGuidelineLayer(guideline)
+        guidelines = list(self.selectedGuidelines)
+        angles = [guideline.angle for guideline in guidelines]
+        colors = [
+            self.getGuidelineHighlightColor(guideline)
+            for guideline in guidelines
+        ]
+        positions = [(guideline.x, guideline.y) for guideline in guidelines]
+        offset = self.getMergedHighlightOffset(guidelines, angles, colors, positions)
+        if offset is not None:
+            with container.sublayerGroup():
+                for layer in self.mergedHighlightLayers.values():
+                    layer.setPosition(offset)
+            return
+        pens = {}
+        for color, angle, (x, y) in zip(colors, angles, positions):
+            pen = pens.get(color)
+            if pen is None:
+                pen = pens[color] = merz.MerzPen()
+            (sx, sy), (ex, ey) = getGuidelinePathPointsForAngle(angle)
+            pen.moveTo((x + sx, y + sy))
+            pen.lineTo((x + ex, y + ey))
+            pen.endPath()
+        with container.sublayerGroup():
+            for color in list(self.mergedHighlightLayers.keys()):
+                if color not in pens:
+                    layer = self.mergedHighlightLayers.pop(color)
+                    container.removeSublayer(layer)
+            for color, pen in pens.items():
+                layer = self.mergedHighlightLayers.get(color)
+                if layer is None:
+                    layer = container.appendPathSublayer(
+                        fillColor=None,
                         strokeColor=color,
                         strokeWidth=self.highlightStrokeWidth
                     )
+                    self.mergedHighlightLayers[color] = layer
+                with layer.propertyGroup():
+                    layer.setPosition((0, 0))
+                    layer.setPath(pen.path)
+        self.mergedHighlightBase = (guidelines, angles, colors, positions)
+
+    def getMergedHighlightOffset(self, guidelines, angles, colors, positions):
+        """
+        Get the (dx, dy) that the merged highlights
+        can be shifted by to show the guidelines at
+        the given positions, or None if they need to
+        be drawn again. Moving a horizontal guideline
+        in x or a vertical one in y does not change
+        how it looks, so those moves are ignored.
+        """
+        base = self.mergedHighlightBase
+        if base is None:
+            return None
+        baseGuidelines, baseAngles, baseColors, basePositions = base
+        if len(guidelines) != len(baseGuidelines):
+            return None
+        if angles != baseAngles or colors != baseColors:
+            return None
+        dx = dy = None
+        items = zip(guidelines, baseGuidelines, angles, positions, basePositions)
+        for guideline, baseGuideline, angle, (x, y), (bx, by) in items:
+            if guideline is not baseGuideline:
+                return None
+            if not isHorizontalAngle(angle):
+                if dx is None:
+                    dx = x - bx
+                elif x - bx != dx:
+                    return None
+            if not isVerticalAngle(angle):
+                if dy is None:
+                    dy = y - by
+                elif y - by != dy:
+                    return None
+        return (dx or 0, dy or 0)
+
+    # Highlight Layers
+    # ----------------
+    # The values last given to each highlight layer
+    # are stored as (position, angle, color) so that
+    # only the properties that changed are pushed to
+    # the layer. Highlight colors are cached per
+    # guideline and dropped when a guideline is
+    # edited or the defaults change.
+
+    def appendSelectedGuidelineLayer(self, guideline):
+        container = self.selectionIndicatorLayer
+        position = (guideline.x, guideline.y)
+        angle = guideline.angle
+        color = self.getGuidelineHighlightColor(guideline)
+        startPoint, endPoint = getGuidelinePathPointsForAngle(angle)
+        self.selectedGuidelineLayers[guideline] = container.appendLineSublayer(
+            position=position,
+            startPoint=startPoint,
+            endPoint=endPoint,
+            strokeColor=color,
+            strokeWidth=self.highlightStrokeWidth
+        )
+        self.selectedGuidelineLayerValues[guideline] = (position, angle, color)
+
+    def removeSelectedGuidelineLayer(self, guideline):
+        layer = self.selectedGuidelineLayers.pop(guideline)
+        self.selectedGuidelineLayerValues.pop(guideline, None)
+        self.selectionIndicatorLayer.removeSublayer(layer)
+
+    def updateSelectedGuidelineLayer(self, guideline):
+        position = (guideline.x, guideline.y)
+        angle = guideline.angle
+        color = self.getGuidelineHighlightColor(guideline)
+        values = (position, angle, color)
+        previous = self.selectedGuidelineLayerValues.get(guideline)
+        if values == previous:
+            return
+        if previous is None:
+            previous = (None, None, None)
+        previousPosition, previousAngle, previousColor = previous
+        layer = self.selectedGuidelineLayers[guideline]
+        with layer.propertyGroup():
+            if position != previousPosition:
+                layer.setPosition(position)
+            if angle != previousAngle:
+                startPoint, endPoint = getGuidelinePathPointsForAngle(angle)
+                layer.setStartPoint(startPoint)
+                layer.setEndPoint(endPoint)
+            if color != previousColor:
+                layer.setStrokeColor(color)
+        self.selectedGuidelineLayerValues[guideline] = values
+
+    def getGuidelineHighlightColor(self, guideline):
+        # the cache is checked against the guideline's own
+        # color so that changes made outside of the tool,
+        # by a script or another editor, are picked up.
+        guidelineColor = guideline.color
+        cached = self.guidelineHighlightColors.get(guideline)
+        if cached is not None and cached[0] == guidelineColor:
+            return cached[1]
+        color = getGuidelineHighlightColor(
+            guideline,
+            self.colorFontGuideline,
+            self.colorGlyphGuideline,
+            self.highlightAlphaScale
+        )
+        self.guidelineHighlightColors[guideline] = (guidelineColor, color)
+        return color
 
     def guidelineEditedInEditor(self, event):
         guideline = event["guideline"]
+        self.guidelineHighlightColors.pop(guideline, None)
         if guideline in self.selectedGuidelines:
             self.displaySelectedGuidelines()
 
     def updateSelectedGuidelineColors(self):
-        for guideline, layer in self.selectedGuidelineLayers.items():
-            color = getGuidelineHighlightColor(
-                guideline,
-                self.colorFontGuideline,
-                self.colorGlyphGuideline,
-                self.highlightAlphaScale
-            )
-            layer.setStrokeColor(color)
+        self.guidelineHighlightColors = {}
+        if self.mergedHighlightLayers:
+            self.displaySelectedGuidelines()
+            return
+        for guideline in self.selectedGuidelineLayers.keys():
+            self.updateSelectedGuidelineLayer(guideline)
 
     def displayMarquee(self, point=None):
         skip = False
@@ -274,7 +567,9 @@ class GuidelineTool(BaseEventTool):
         return ((vX, vY), (vW, vH))
 
     def mouseDown(self, point, clickCount):
-        self.mouseSequenceUndoCoalescing = set()
+        self.finishNudge()
+        self.undoGroup = GuidelineUndoGroup()
+        self.snapToPoints = None
         shouldIgnoreFollowingMouseEvents = False
         self.mouseDownPoint = point
         self.isDraggingGuidelines = False
@@ -289,27 +584,23 @@ class GuidelineTool(BaseEventTool):
         if hitGuideline:
             # open editor
             if clickCount == 2:
-                self.selectedGuidelines = {
-                    hitGuideline : getGuidelineState(hitGuideline)
-                }
+                self.selectedGuidelines.set([hitGuideline])
                 self.openGuidelineEditor()
             # modifying selected guides
             elif shiftDown:
                 # remove
                 if hitGuideline in self.selectedGuidelines:
-                    del self.selectedGuidelines[hitGuideline]
+                    self.selectedGuidelines.remove(hitGuideline)
                 # add
                 else:
-                    self.selectedGuidelines[hitGuideline] = getGuidelineState(hitGuideline)
+                    self.selectedGuidelines.add(hitGuideline)
                     self.isDraggingGuidelines = True
             # initiating drag
             elif hitGuideline in self.selectedGuidelines:
                 self.isDraggingGuidelines = True
             # selecting new
             else:
-                self.selectedGuidelines = {
-                    hitGuideline : getGuidelineState(hitGuideline)
-                }
+                self.selectedGuidelines.set([hitGuideline])
                 self.isDraggingGuidelines = True
         else:
             isInRuler, rulerData = self.isInRuler(point)
@@ -327,18 +618,12 @@ class GuidelineTool(BaseEventTool):
                 dest = self.getGlyph()
                 if commandDown:
                     dest = dest.font
-                # XXX can't put an undo state for this on the font
-                if not commandDown:
-                    if dest not in self.mouseSequenceUndoCoalescing:
-                        dest.prepareUndo("Add guideline")
-                        self.mouseSequenceUndoCoalescing.add(dest)
                 guideline = dest.appendGuideline(
                     position=(x, y),
                     angle=angle
                 )
-                self.selectedGuidelines = {
-                    guideline : getGuidelineState(guideline)
-                }
+                self.undoGroup.recordAddedGuideline(guideline, "Add Guideline")
+                self.selectedGuidelines.set([guideline])
             # drag from ruler
             elif isInRuler:
                 x, y = rulerData["point"]
@@ -348,22 +633,16 @@ class GuidelineTool(BaseEventTool):
                 dest = self.getGlyph()
                 if commandDown:
                     dest = dest.font
-                # XXX can't put an undo state for this on the font
-                if not commandDown:
-                    if dest not in self.mouseSequenceUndoCoalescing:
-                        dest.prepareUndo("Move guideline")
-                        self.mouseSequenceUndoCoalescing.add(dest)
                 guideline = dest.appendGuideline(
                     position=(x, y),
                     angle=angle
                 )
-                self.selectedGuidelines = {
-                    guideline : getGuidelineState(guideline)
-                }
+                self.undoGroup.recordAddedGuideline(guideline, "Add Guideline")
+                self.selectedGuidelines.set([guideline])
                 self.isDraggingGuidelines = True
             # deselect and start marquee
             else:
-                self.selectedGuidelines = {}
+                self.selectedGuidelines.clear()
                 self.inRectSelection = True
         self.displaySelectedGuidelines()
 
@@ -407,25 +686,56 @@ class GuidelineTool(BaseEventTool):
         )
         return isInRuler, data
 
+    # Drag Pacing
+    # -----------
+    # Drag events can arrive faster than the display
+    # refreshes. Only the latest point is kept and it
+    # is processed at most once per frame. The first
+    # event is processed right away and any pending
+    # point is processed before the mouse up.
+
     def mouseDragged(self, point, delta):
+        self.pendingDragPoint = point
+        if self.dragTimer is None:
+            self.processPendingDrag()
+            self.dragTimer = FrameTimer(self.dragTimerFired)
+
+    def dragTimerFired(self):
+        if self.pendingDragPoint is None:
+            self.dragTimer = None
+            return False
+        self.processPendingDrag()
+        return True
+
+    def stopDragTimer(self):
+        if self.dragTimer is not None:
+            self.dragTimer.stop()
+        self.dragTimer = None
+
+    def processPendingDrag(self):
+        point = self.pendingDragPoint
+        if point is None:
+            return
+        self.pendingDragPoint = None
+        self.processMouseDragged(point)
+
+    def processMouseDragged(self, point):
         modifiers = self.getModifiers()
         shiftDown = modifiers["shiftDown"]
         capLockDown = modifiers["capLockDown"]
         commandDown = modifiers["commandDown"]
         optionDown = modifiers["optionDown"]
         controlDown = modifiers["controlDown"]
+        selectionDiff = None
         # marquee selection
         if self.inRectSelection:
-            self.selectedGuidelines = self.findGuidelinesIntersectedBySelectionRect()
+            selectionDiff = self.updateSelectionFromSelectionRect()
         # editing
         elif self.isDraggingGuidelines:
             # origin editing
             if commandDown and len(self.selectedGuidelines) == 1:
                 guideline = self.selectedGuideline
-                parent = getGuidelineParentForUndo(guideline)
-                if parent not in self.mouseSequenceUndoCoalescing:
-                    self.mouseSequenceUndoCoalescing.add(parent)
-                    parent.prepareUndo("Move Guideline")
+                self.undoGroup.recordGuideline(guideline, "Move Guideline")
                 x, y = point
                 x = bezierTools.roundValue(x, self.roundValuesTo)
                 y = bezierTools.roundValue(y, self.roundValuesTo)
@@ -436,10 +746,7 @@ class GuidelineTool(BaseEventTool):
                 x, y = point
                 guideline = self.selectedGuideline
                 if bezierTools.distanceFromPointToPoint((guideline.x, guideline.y), (x, y)) > 5:
-                    parent = getGuidelineParentForUndo(guideline)
-                    if parent not in self.mouseSequenceUndoCoalescing:
-                        self.mouseSequenceUndoCoalescing.add(parent)
-                        parent.prepareUndo("Change Guideline Angle")
+                    self.undoGroup.recordGuideline(guideline, "Change Guideline Angle")
                     guideline.angle = bezierTools.calculateAngle(
                         (guideline.x, guideline.y),
                         (x, y)
@@ -450,79 +757,57 @@ class GuidelineTool(BaseEventTool):
                 if len(self.selectedGuidelines) == 1:
                     x, y = point
                     guideline = self.selectedGuideline
-                    state = self.selectedGuidelines[guideline]
-                    dx = x - state.x
-                    dy = y - state.y
+                    sx, sy, angle = self.selectedGuidelines.getStart(guideline)
+                    dx = x - sx
+                    dy = y - sy
                 # dragging > 1
                 else:
                     sx, sy = self.mouseDownPoint
                     x, y = point
                     dx = x - sx
                     dy = y - sy
-                self.snappingToThesePoints = set()
-                snapTo = self.wantsSnapToPoint
-                if snapTo:
-                    snapTo = len(self.selectedGuidelines) == 1
-                for guideline, state in self.selectedGuidelines.items():
-                    parent = getGuidelineParentForUndo(guideline)
-                    if parent not in self.mouseSequenceUndoCoalescing:
-                        self.mouseSequenceUndoCoalescing.add(parent)
-                        parent.prepareUndo("Move Guideline")
-                    x = state.x
-                    y = state.y
-                    angle = state.angle
-                    if angle in horizontalAngles:
-                        y += dy
-                    elif angle in verticalAngles:
-                        x += dx
-                    else:
-                        x += dx
-                        y += dy
+                selection = self.selectedGuidelines
+                dragged = zip(
+                    selection,
+                    selection.getDraggedPositions(dx, dy),
+                    selection.getAxes()
+                )
+                positions = []
+                for guideline, (x, y), axis in dragged:
+                    self.undoGroup.recordGuideline(guideline, "Move Guideline")
                     x = bezierTools.roundValue(x, self.roundValuesTo)
                     y = bezierTools.roundValue(y, self.roundValuesTo)
-                    if snapTo:
-                        self.snappingToThesePoints = self.findSnapToPoints((x, y), angle)
-                        self.snapToPointSymbolColor = getGuidelineHighlightColor(
-                            guideline,
-                            self.colorFontGuideline,
-                            self.colorGlyphGuideline,
-                            self.highlightAlphaScale
-                        )
-                        if self.snappingToThesePoints:
-                            snapTo = list(self.snappingToThesePoints)[0]
-                            if angle in horizontalAngles:
-                                y = snapTo[1]
-                            elif angle in verticalAngles:
-                                x = snapTo[0]
-                            else:
-                                x, y = snapTo
-                    guideline.x = x
-                    guideline.y = y
-        self.displaySelectedGuidelines()
+                    positions.append([guideline, x, y, axis])
+                self.snappingToThesePoints = set()
+                if self.snapSourceNames:
+                    self.snapGuidelinePositions(positions)
+                with holdGuidelineNotifications(selection, "Guide Tool drag"):
+                    for guideline, x, y, axis in positions:
+                        guideline.x = x
+                        guideline.y = y
+        self.displaySelectedGuidelines(selectionDiff)
         self.displaySnapToPoints()
         self.displayMarquee(point)
 
     def mouseUp(self, point):
+        self.stopDragTimer()
+        self.processPendingDrag()
         # marquee selection
         if self.inRectSelection:
-            self.selectedGuidelines = self.findGuidelinesIntersectedBySelectionRect()
-        # close undo coalescing
-        if self.mouseSequenceUndoCoalescing:
-            for obj in self.mouseSequenceUndoCoalescing:
-                if obj is not None:
-                    obj.performUndo()
+            self.updateSelectionFromSelectionRect()
+        # register the undo for the gesture
+        if self.undoGroup is not None:
+            self.undoGroup.register(self.getUndoManager(), self.guidelinesUndone)
         # update the stored states after the drag
         # in case the user begins another drag with
         # the same selection
-        self.selectedGuidelines = {
-            guideline : getGuidelineState(guideline)
-            for guideline in self.selectedGuidelines.keys()
-        }
+        self.selectedGuidelines.refresh()
         self.inRectSelection = False
         self.isDraggingGuidelines = False
         self.mouseDownPoint = None
         self.snappingToThesePoints = []
-        self.mouseSequenceUndoCoalescing = None
+        self.snapToPoints = None
+        self.undoGroup = None
         self.displaySnapToPoints()
         self.displaySelectedGuidelines()
         self.displayMarquee()
@@ -537,25 +822,12 @@ class GuidelineTool(BaseEventTool):
                 self.openGuidelineEditor()
             elif key in deleteKeys:
                 didSomething = True
-                glyph = self.getGlyph()
-                font = glyph.font
-                glyphGuidelines = []
-                fontGuidelines = []
-                for guideline, state in self.selectedGuidelines.items():
-                    g = state.glyph
-                    if g is not None:
-                        glyphGuidelines.append(guideline)
-                    else:
-                        fontGuidelines.append(guideline)
-                if glyphGuidelines:
-                    with glyph.undo("Delete Guidelines"):
-                        for guideline in glyphGuidelines:
-                            glyph.removeGuideline(guideline)
-                if fontGuidelines:
-                    with font.undo("Delete Guidelines"):
-                        for guideline in fontGuidelines:
-                            font.removeGuideline(guideline)
-                self.selectedGuidelines = {}
+                self.finishNudge()
+                self.removeGuidelines(
+                    list(self.selectedGuidelines),
+                    "Delete Guidelines"
+                )
+                self.selectedGuidelines.clear()
             else:
                 arrowUp = event["up"]
                 arrowDown = event["down"]
@@ -584,42 +856,98 @@ class GuidelineTool(BaseEventTool):
                     dy *= multiplier
                     dx = bezierTools.roundValue(dx, self.roundValuesTo)
                     dy = bezierTools.roundValue(dy, self.roundValuesTo)
-                    for guideline in self.selectedGuidelines.keys():
-                        guideline.naked().prepareUndo("Move Guideline")
-                        guideline.x += dx
-                        guideline.y += dy
-                        guideline.naked().performUndo()
+                    self.nudgeSelectedGuidelines(dx, dy)
             self.displaySelectedGuidelines()
         if not didSomething:
             super().keyDown(nsEvent)
 
+    def keyUp(self, nsEvent):
+        if self.nudgeUndoGroup is not None or self.nudgeDelta is not None:
+            self.finishNudge()
+            self.displaySelectedGuidelines()
+        else:
+            super().keyUp(nsEvent)
+
+    # Nudging
+    # -------
+    # Arrow keys (and their auto repeats) add to a
+    # pending delta that is applied at most once per
+    # frame. The first nudge is applied right away.
+    # A held key sequence is one undo action that is
+    # closed when the key is released.
+
+    def nudgeSelectedGuidelines(self, dx, dy):
+        if self.nudgeDelta is None:
+            self.nudgeDelta = (dx, dy)
+        else:
+            pendingX, pendingY = self.nudgeDelta
+            self.nudgeDelta = (pendingX + dx, pendingY + dy)
+        if self.nudgeTimer is None:
+            self.applyPendingNudge()
+            self.nudgeTimer = FrameTimer(self.nudgeTimerFired)
+
+    def nudgeTimerFired(self):
+        if self.nudgeDelta is None:
+            self.nudgeTimer = None
+            return False
+        self.applyPendingNudge()
+        self.displaySelectedGuidelines()
+        return True
+
+    def stopNudgeTimer(self):
+        if self.nudgeTimer is not None:
+            self.nudgeTimer.stop()
+        self.nudgeTimer = None
+
+    def applyPendingNudge(self):
+        if self.nudgeDelta is None:
+            return
+        dx, dy = self.nudgeDelta
+        self.nudgeDelta = None
+        if not self.selectedGuidelines:
+            return
+        if self.nudgeUndoGroup is None:
+            self.nudgeUndoGroup = GuidelineUndoGroup()
+        undoGroup = self.nudgeUndoGroup
+        with holdGuidelineNotifications(self.selectedGuidelines, "Guide Tool nudge"):
+            for guideline in self.selectedGuidelines:
+                undoGroup.recordGuideline(guideline, "Move Guideline")
+                guideline.x += dx
+                guideline.y += dy
+
+    def finishNudge(self):
+        self.stopNudgeTimer()
+        self.applyPendingNudge()
+        if self.nudgeUndoGroup is None:
+            return
+        self.nudgeUndoGroup.register(self.getUndoManager(), self.guidelinesUndone)
+        self.nudgeUndoGroup = None
+        # update the stored states for the next drag
+        self.selectedGuidelines.refresh()
+
     def acceptMenuEditCallbacks(self, menuItem):
         return True
 
     def selectAll(self):
-        glyph = self.getGlyph()
-        font = glyph.font
-        self.selectedGuidelines = {}
-        for guideline in glyph.guidelines:
-            self.selectedGuidelines[guideline] = getGuidelineState(guideline)
-        for guideline in font.guidelines:
-            self.selectedGuidelines[guideline] = getGuidelineState(guideline)
+        registry = self.getGuidelineRegistry()
+        self.selectedGuidelines.set(
+            registry.getGuidelines("glyph") + registry.getGuidelines("font")
+        )
         self.displaySelectedGuidelines()
 
     def deselectAll(self):
-        self.selectedGuidelines = {}
+        self.selectedGuidelines.clear()
         self.displaySelectedGuidelines()
 
     # Contextual Menu
 
     def additionContextualMenuItems(self):
-        glyph = self.getGlyph()
-        font = glyph.font
-        fontGuidelines = font.guidelines
-        glyphGuidelines = glyph.guidelines
+        registry = self.getGuidelineRegistry()
+        fontGuidelines = registry.getGuidelines("font")
+        glyphGuidelines = registry.getGuidelines("glyph")
         selectedFontGuidelines = []
         selectedGlyphGuidelines = []
-        for guideline in self.selectedGuidelines.keys():
+        for guideline in self.selectedGuidelines:
             if guideline.glyph is not None:
                 selectedGlyphGuidelines.append(guideline)
             else:
@@ -655,57 +983,95 @@ class GuidelineTool(BaseEventTool):
         return items
 
     def menuClearAllCallback(self, sender):
-        glyph = self.getGlyph()
-        font = glyph.font
-        font.clearGuidelines()
-        glyph.clearGuidelines()
+        registry = self.getGuidelineRegistry()
+        guidelines = list(registry.getGuidelines("font"))
+        guidelines += registry.getGuidelines("glyph")
+        self.removeGuidelines(guidelines, "Clear Guidelines")
+        self.selectedGuidelines.clear()
+        self.displaySelectedGuidelines()
 
     def menuClearFontCallback(self, sender):
-        glyph = self.getGlyph()
-        font = glyph.font
-        font.clearGuidelines()
-        self.selectedGuidelines = {}
+        registry = self.getGuidelineRegistry()
+        guidelines = list(registry.getGuidelines("font"))
+        self.removeGuidelines(guidelines, "Clear Font Guidelines")
+        self.selectedGuidelines.clear()
         self.displaySelectedGuidelines()
 
     def menuClearGlyphCallback(self, sender):
-        glyph = self.getGlyph()
-        glyph.clearGuidelines()
-        self.selectedGuidelines = {}
+        registry = self.getGuidelineRegistry()
+        guidelines = list(registry.getGuidelines("glyph"))
+        self.removeGuidelines(guidelines, "Clear Glyph Guidelines")
+        self.selectedGuidelines.clear()
         self.displaySelectedGuidelines()
 
     def menuConvertToFontCallback(self, sender):
         glyphGuidelines = []
-        for guideline, state in self.selectedGuidelines.items():
-            glyph = state.glyph
-            if glyph is not None:
+        for guideline in self.selectedGuidelines:
+            if self.selectedGuidelines.isGlyphGuideline(guideline):
                 glyphGuidelines.append(guideline)
-        glyph = self.getGlyph()
-        font = glyph.font
-        for guideline in glyphGuidelines:
-            del self.selectedGuidelines[guideline]
-            glyph.removeGuideline(guideline)
-            guideline = font.appendGuideline(
-                guideline=guideline.copy()
-            )
-            self.selectedGuidelines[guideline] = getGuidelineState(guideline)
+        self.convertGuidelines(glyphGuidelines, True)
         self.displaySelectedGuidelines()
 
     def menuConvertToGlyphCallback(self, sender):
         fontGuidelines = []
-        for guideline, state in self.selectedGuidelines.items():
-            glyph = state.glyph
-            if glyph is None:
+        for guideline in self.selectedGuidelines:
+            if not self.selectedGuidelines.isGlyphGuideline(guideline):
                 fontGuidelines.append(guideline)
+        self.convertGuidelines(fontGuidelines, False)
+        self.displaySelectedGuidelines()
+
+    # Removing and Converting
+    # -----------------------
+    # These are recorded in a GuidelineUndoGroup like
+    # moves are, so the undo only holds the guidelines
+    # that were removed or converted. A converted
+    # guideline is a removal from one parent and an
+    # addition to the other.
+
+    def removeGuidelines(self, guidelines, actionName):
+        if not guidelines:
+            return
         glyph = self.getGlyph()
         font = glyph.font
-        for guideline in fontGuidelines:
-            del self.selectedGuidelines[guideline]
-            font.removeGuideline(guideline)
-            guideline = glyph.appendGuideline(
-                guideline=guideline.copy()
-            )
-            self.selectedGuidelines[guideline] = getGuidelineState(guideline)
-        self.displaySelectedGuidelines()
+        undoGroup = GuidelineUndoGroup()
+        with holdGuidelineNotifications(guidelines, note=actionName):
+            for guideline in guidelines:
+                undoGroup.recordGuideline(guideline, actionName)
+            for guideline in guidelines:
+                if guideline.glyph is not None:
+                    glyph.removeGuideline(guideline)
+                else:
+                    font.removeGuideline(guideline)
+        undoGroup.register(self.getUndoManager(), self.guidelinesUndone)
+
+    def convertGuidelines(self, guidelines, toFont):
+        if not guidelines:
+            return
+        glyph = self.getGlyph()
+        font = glyph.font
+        if toFont:
+            actionName = "Convert to Font Guidelines"
+            source, destination = glyph, font
+        else:
+            actionName = "Convert to Glyph Guidelines"
+            source, destination = font, glyph
+        undoGroup = GuidelineUndoGroup()
+        parents = (glyph.naked(), font.naked())
+        with holdGuidelineParentNotifications(parents, note=actionName):
+            for guideline in guidelines:
+                undoGroup.recordGuideline(guideline, actionName)
+            for guideline in guidelines:
+                self.selectedGuidelines.remove(guideline)
+                source.removeGuideline(guideline)
+                guideline = destination.appendGuideline(
+                    guideline=guideline.copy()
+                )
+                if not toFont:
+                    # smart guides are hidden in the font
+                    setGuidelineVisible(guideline, True)
+                undoGroup.recordAddedGuideline(guideline, actionName)
+                self.selectedGuidelines.add(guideline)
+        undoGroup.register(self.getUndoManager(), self.guidelinesUndone)
 
     # Italic Support
 
@@ -724,122 +1090,302 @@ class GuidelineTool(BaseEventTool):
     def _get_selectedGuideline(self):
         if len(self.selectedGuidelines) != 1:
             return None
-        guideline = list(self.selectedGuidelines.keys())[0]
+        guideline = next(iter(self.selectedGuidelines))
         return guideline
 
     selectedGuideline = property(_get_selectedGuideline)
 
     def findGuidelineAtPoint(self, point):
-        glyph = self.getGlyph()
-        font = glyph.font
-        guidelines = font.guidelines + glyph.guidelines
-        for guideline in guidelines:
-            naked = guideline.naked()
-            path = naked.getRepresentation("doodle.GuidelinePath")
-            scale = self.getNSView().inverseScale()
-            padding = scale * 2
-            if path.isStrokeHitByPoint_padding_(point, padding):
-                return guideline
+        registry = self.getGuidelineRegistry()
+        scale = self.getNSView().inverseScale()
+        padding = scale * 2
+        hit = None
+        hitDistance = None
+        for key in ("font", "glyph"):
+            index = registry.getLineIndex(key)
+            if index is None:
+                continue
+            i, distance = index.findNearest(point, padding)
+            if i is None:
+                continue
+            if hitDistance is None or distance < hitDistance:
+                hit = (key, i)
+                hitDistance = distance
+        if hit is None:
+            return None
+        key, i = hit
+        return registry.getGuidelines(key)[i]
 
     def findGuidelinesIntersectedBySelectionRect(self):
-        (xMin, yMin), (w, h) = self.getMarqueRect()
-        xMax = xMin + w
-        yMax = yMin + h
-        rectLines = [
-            ((xMin, yMin), (xMin, yMax)),
-            ((xMin, yMax), (xMax, yMax)),
-            ((xMax, yMax), (xMax, yMin)),
-            ((xMax, yMin), (xMin, yMin))
-        ]
-        glyph = self.getGlyph()
-        font = glyph.font
-        guidelines = glyph.guidelines
-        guidelines += font.guidelines
-        hits = {}
-        for guideline in guidelines:
-            beam = guideline.naked().getRepresentation("doodle.GuidelineBeam")
-            for rectLine in rectLines:
-                points = beam + rectLine
-                if bezierTools.intersectLineLine(*points).points:
-                    hits[guideline] = getGuidelineState(guideline)
-                    break
+        rect = self.getMarqueRect()
+        registry = self.getGuidelineRegistry()
+        hits = []
+        for key in ("glyph", "font"):
+            index = registry.getLineIndex(key)
+            if index is None:
+                continue
+            indexes = index.findIntersectingRect(rect)
+            if not indexes:
+                continue
+            guidelines = registry.getGuidelines(key)
+            for i in sorted(indexes):
+                hits.append(guidelines[i])
         return hits
 
-    def findSnapToPoints(self, point, angle):
-        glyph = self.getGlyph()
+    def updateSelectionFromSelectionRect(self):
+        """
+        Select the guidelines intersected by the
+        selection rect and return the selection
+        diff as (added, removed).
+        """
+        hits = self.findGuidelinesIntersectedBySelectionRect()
+        return self.selectedGuidelines.update(hits)
+
+    def snapGuidelinePositions(self, positions):
+        """
+        Snap a group of [guideline, x, y, axis]
+        positions in place. All selected guidelines
+        are looked up in one query and the whole group
+        is moved by the offset of the nearest snap.
+        """
         scale = self.getNSView().inverseScale()
-        x, y = point
         padding = scale * 4
-        xMin = x - padding
-        xMax = x + padding
-        yMin = y - padding
-        yMax = y + padding
-        hits = {}
-        snapToPoints = glyph.getRepresentation(
-            snapToPointsKey,
-            removeOverlap=self.wantsSnapToFuturePoints
+        snapToPoints = self.getSnapToPoints()
+        queries = [(x, y, axis) for guideline, x, y, axis in positions]
+        results = snapToPoints.findNearestOffsets(queries, padding)
+        snap = chooseGroupOffset(results)
+        if snap is None:
+            return
+        dx, dy, points, indexes = snap
+        for position in positions:
+            axis = position[3]
+            if axis != "y":
+                position[1] += dx
+            if axis != "x":
+                position[2] += dy
+        # put the snapped guidelines exactly
+        # on the points they snapped to
+        for i in indexes:
+            position = positions[i]
+            axis = position[3]
+            x, y = next(iter(results[i][4]))
+            if axis != "y":
+                position[1] = x
+            if axis != "x":
+                position[2] = y
+        self.snappingToThesePoints = points
+        self.snapToPointSymbolColor = self.getGuidelineHighlightColor(
+            positions[indexes[0]][0]
         )
-        for point in snapToPoints:
-            px, py = point
-            distance = None
-            if angle in horizontalAngles:
-                if yMin <= py and py <= yMax:
-                    distance = abs(y - py)
-            elif angle in verticalAngles:
-                if xMin <= px and px <= xMax:
-                    distance = abs(x - px)
+
+    # Snap To Points
+
+    def getSnapToPoints(self):
+        """
+        Get the snap to points index for the current
+        gesture. The index combines the points from
+        the enabled snap sources and is built once
+        per gesture. Sources that are not ready yet
+        are left out and the index is rebuilt when
+        they are.
+        """
+        glyph = self.getGlyph()
+        if self.snapToPoints is not None:
+            ready = [
+                name
+                for name in self.pendingSnapSources
+                if snapSources[name][1](self, glyph) is not None
+            ]
+            if not ready:
+                return self.snapToPoints
+        points = set()
+        pending = []
+        for name in self.snapSourceNames:
+            sourcePoints = snapSources[name][1](self, glyph)
+            if sourcePoints is None:
+                pending.append(name)
             else:
-                distance = bezierTools.distanceFromPointToPoint((x, y), point)
-                if distance > padding:
-                    distance = None
-            if distance is None:
-                continue
-            if distance not in hits:
-                hits[distance] = set()
-            hits[distance].add(point)
-        if not hits:
-            return set()
-        closest = min(hits.keys())
-        return hits[closest]
+                points.update(sourcePoints)
+        self.snapToPoints = SnapPointIndex(points)
+        self.pendingSnapSources = pending
+        return self.snapToPoints
+
+    def getFuturePointsJob(self, glyph):
+        job = glyph.getRepresentation(futurePointsJobKey)
+        if job.cancelled:
+            # a job that was cancelled while its state was
+            # still current would otherwise never finish
+            glyph.naked().destroyRepresentation(futurePointsJobKey)
+            job = glyph.getRepresentation(futurePointsJobKey)
+        previous = self.futurePointsJob
+        if job is not previous:
+            # a new job for the same glyph means that its
+            # outline changed and the previous result is
+            # stale. jobs of other glyphs are left to finish
+            # since their results are still valid.
+            if previous is not None and previous.belongsTo(glyph):
+                previous.cancel()
+            self.futurePointsJob = job
+        return job
+
+    def prewarmSnapToPoints(self):
+        glyph = self.getGlyph()
+        if glyph is None:
+            return
+        if "futurePoint" in self.snapSourceNames:
+            self.getFuturePointsJob(glyph)
 
 
 # -----
 # Tools
 # -----
 
-GuidelineState = namedtuple(
-    "GuidelineState",
-    [
-        "font",
-        "glyph",
-        "x",
-        "y",
-        "angle"
-    ]
-)
+class FrameTimer:
+
+    """
+    Call a function once per display frame
+    until it returns False or the timer is
+    stopped.
+    """
+
+    interval = 1 / 60
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.target = CallbackWrapper(self._fired)
+        self.timer = AppKit.NSTimer.scheduledTimerWithTimeInterval_target_selector_userInfo_repeats_(
+            self.interval,
+            self.target,
+            "action:",
+            None,
+            True
+        )
 
-def getGuidelineState(guideline):
-    glyph = guideline.glyph
-    font = guideline.font
-    state = GuidelineState(
-        font=font,
-        glyph=glyph,
-        x=guideline.x,
-        y=guideline.y,
-        angle=guideline.angle
-    )
-    return state
+    def _fired(self, timer):
+        if not self.callback():
+            self.stop()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.invalidate()
+        self.timer = None
+        self.target = None
+
+class GuidelineRegistry:
+
+    """
+    The guidelines of the current glyph and its font.
+    The wrapped guideline lists are kept until guidelines
+    are added to or removed from the glyph or the font,
+    so events don't have to wrap and scan them again.
+    The lists are checked after a GuidelinesChanged
+    notification. Moves keep the lists and only
+    invalidate the line index representations.
+    """
+
+    def __init__(self):
+        self.parents = {}
+        self.entries = {}
+        self.changed = set()
+
+    def setGlyph(self, glyph):
+        current = self.parents.get("glyph")
+        if glyph is None:
+            if current is None:
+                return
+        elif current is not None and current.naked() is glyph.naked():
+            return
+        self._removeObservers()
+        self.parents = {}
+        self.entries = {}
+        self.changed = set()
+        if glyph is None:
+            return
+        self.parents["glyph"] = glyph
+        glyph.naked().addObserver(self, "glyphGuidelinesChanged", "Glyph.GuidelinesChanged")
+        font = glyph.font
+        if font is not None:
+            self.parents["font"] = font
+            font.naked().addObserver(self, "fontGuidelinesChanged", "Font.GuidelinesChanged")
+
+    def _removeObservers(self):
+        glyph = self.parents.get("glyph")
+        if glyph is not None:
+            glyph.naked().removeObserver(self, "Glyph.GuidelinesChanged")
+        font = self.parents.get("font")
+        if font is not None:
+            font.naked().removeObserver(self, "Font.GuidelinesChanged")
+
+    def glyphGuidelinesChanged(self, notification):
+        self.changed.add("glyph")
+
+    def fontGuidelinesChanged(self, notification):
+        self.changed.add("font")
+
+    def _getEntry(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and key not in self.changed:
+            return entry
+        self.changed.discard(key)
+        parent = self.parents.get(key)
+        if parent is None:
+            return None
+        identities = tuple(id(guideline) for guideline in parent.naked().guidelines)
+        if entry is not None and entry[1] == identities:
+            return entry
+        entry = (tuple(parent.guidelines), identities, frozenset(identities))
+        self.entries[key] = entry
+        return entry
+
+    def getGuidelines(self, key):
+        """
+        Get the wrapped guidelines of "glyph" or "font".
+        """
+        entry = self._getEntry(key)
+        if entry is None:
+            return ()
+        return entry[0]
+
+    def getLineIndex(self, key):
+        parent = self.parents.get(key)
+        if parent is None:
+            return None
+        return parent.naked().getRepresentation(guidelineLineIndexKey)
+
+    def contains(self, guideline):
+        identity = id(guideline.naked())
+        for key in ("glyph", "font"):
+            entry = self._getEntry(key)
+            if entry is not None and identity in entry[2]:
+                return True
+        return False
 
 def getGuidelinePathPoints(guideline):
+    return getGuidelinePathPointsForAngle(guideline.angle)
+
+@functools.lru_cache(maxsize=256)
+def getGuidelinePathPointsForAngle(angle):
     bigNumber = 10000
-    fx = math.cos(math.radians(guideline.angle))
-    fy = math.sin(math.radians(guideline.angle))
-    afx = math.cos(math.radians(guideline.angle + 90))
-    afy = math.sin(math.radians(guideline.angle + 90))
+    fx = math.cos(math.radians(angle))
+    fy = math.sin(math.radians(angle))
     startPoint = (fx * bigNumber, fy * bigNumber)
     endPoint = (-fx * bigNumber, -fy * bigNumber)
     return (startPoint, endPoint)
 
+@functools.lru_cache(maxsize=8)
+def getStarPolygon(size, pointCount, inner):
+    outerRadius = size / 2
+    innerRadius = outerRadius * inner
+    points = []
+    for i in range(pointCount * 2):
+        if i % 2:
+            radius = innerRadius
+        else:
+            radius = outerRadius
+        angle = math.pi / 2 + math.pi * i / pointCount
+        points.append((math.cos(angle) * radius, math.sin(angle) * radius))
+    return tuple(points)
+
 def getGuidelineHighlightColor(guideline, fontColor, glyphColor, alphaScale):
     if guideline.color is not None:
         color = guideline.color
@@ -855,43 +1401,331 @@ def scaleColorAlpha(color, scale):
     a *= scale
     return (r, g, b, a)
 
-def getGuidelineParentForUndo(guideline):
-    if guideline.glyph is not None:
-        return guideline.glyph
-    return guideline.naked()
-
 # Factories
 
-snapToPointsKey = extensionIdentifier + ".snapToPoints"
-
 def getAllPointsFromGlyph(glyph):
     points = set()
     for contour in glyph:
         for point in contour:
             if point.segmentType is not None:
                 points.add((point.x, point.y))
+    layer = glyph.layer
+    if layer is not None:
+        for component in glyph.components:
+            baseGlyph = component.baseGlyph
+            if baseGlyph not in layer:
+                continue
+            basePoints = layer[baseGlyph].getRepresentation(glyphPointsKey)
+            xx, xy, yx, yy, dx, dy = component.transformation
+            if (xx, xy, yx, yy) == (1, 0, 0, 1):
+                if (dx, dy) == (0, 0):
+                    points |= basePoints
+                else:
+                    points.update((x + dx, y + dy) for x, y in basePoints)
+            else:
+                points.update(
+                    (xx * x + yx * y + dx, xy * x + yy * y + dy)
+                    for x, y in basePoints
+                )
     return points
 
-def snapToPointsRepresentationFactory(glyph, removeOverlap=False):
-    points = getAllPointsFromGlyph(glyph)
-    if removeOverlap:
-        boolGlyph = BooleanGlyph(glyph)
-        boolGlyph = boolGlyph.removeOverlap()
-        result = defcon.Glyph()
-        boolGlyph.drawPoints(result.getPointPen())
-        points |= getAllPointsFromGlyph(result)
-    return points
+# Component Points
+# ----------------
+# The points of a glyph, including the points of its
+# components, are cached so that a component only
+# needs to transform the points of its base glyph.
+# Changes to a base glyph are posted to composites
+# as component changes, so nested composites are
+# invalidated along with their base glyphs.
+
+glyphPointsKey = extensionIdentifier + ".glyphPoints"
+
+glyphPointsInProgress = set()
+
+def glyphPointsRepresentationFactory(glyph):
+    # guard against components that refer
+    # back to the glyph they are in
+    key = id(glyph)
+    if key in glyphPointsInProgress:
+        return frozenset()
+    glyphPointsInProgress.add(key)
+    try:
+        return frozenset(getAllPointsFromGlyph(glyph))
+    finally:
+        glyphPointsInProgress.discard(key)
+
+defcon.registerRepresentationFactory(
+    defcon.Glyph,
+    glyphPointsKey,
+    glyphPointsRepresentationFactory,
+    destructiveNotifications=(
+        "Glyph.ContoursChanged",
+        "Glyph.ComponentsChanged"
+    )
+)
+
+# Future Points
+# -------------
+# The future points are the points that removing
+# overlap would add: the places where the contours
+# cross. Removing overlap is too slow to do on the
+# drag path, so these are computed on a worker
+# thread. The outline is recorded on the main thread
+# and the result is handed back to the main thread
+# when it is ready. A job belongs to one state of the glyph:
+# when the glyph changes the representation is
+# destroyed and the next request creates a new job.
+# Only jobs for a state that no longer exists are
+# cancelled. Switching glyphs or tools leaves the
+# jobs running, so their results are there when
+# the glyph is shown again.
+
+futurePointsJobKey = extensionIdentifier + ".futurePointsJob"
+
+futurePointsExecutor = ThreadPoolExecutor(max_workers=1)
+
+class FuturePointsJob(object):
+
+    def __init__(self, glyph):
+        self.points = None
+        self.cancelled = False
+        self.glyphReference = weakref.ref(glyph)
+        recording = RecordingPen()
+        for contour in glyph:
+            contour.draw(recording)
+        self.future = futurePointsExecutor.submit(
+            self._compute,
+            recording
+        )
+        self.future.add_done_callback(self._computed)
+
+    def belongsTo(self, glyph):
+        if hasattr(glyph, "naked"):
+            glyph = glyph.naked()
+        return self.glyphReference() is glyph
+
+    def cancel(self):
+        self.cancelled = True
+        self.future.cancel()
+
+    def _compute(self, recording):
+        # worker thread
+        if self.cancelled:
+            return None
+        points = getRemoveOverlapPoints(recording)
+        if self.cancelled:
+            return None
+        return frozenset(points)
+
+    def _computed(self, future):
+        # worker thread
+        if self.cancelled or future.cancelled():
+            return
+        if future.exception() is not None:
+            return
+        points = future.result()
+        if points is None:
+            return
+        callAfter(self._finish, points)
+
+    def _finish(self, points):
+        # main thread
+        if self.cancelled:
+            return
+        self.points = points
+
+
+def getRemoveOverlapPoints(recording):
+    # worker thread
+    glyph = defcon.Glyph()
+    recording.replay(glyph.getPen())
+    result = defcon.Glyph()
+    BooleanGlyph(glyph).removeOverlap().drawPoints(result.getPointPen())
+    return getAllPointsFromGlyph(result) - getAllPointsFromGlyph(glyph)
+
+def futurePointsJobRepresentationFactory(glyph):
+    return FuturePointsJob(glyph)
 
 defcon.registerRepresentationFactory(
     defcon.Glyph,
-    snapToPointsKey,
-    snapToPointsRepresentationFactory,
+    futurePointsJobKey,
+    futurePointsJobRepresentationFactory,
     destructiveNotifications=(
         "Glyph.ContoursChanged",
         "Glyph.ComponentsChanged"
     )
 )
 
+guidelineLineIndexKey = extensionIdentifier + ".guidelineLineIndex"
+
+def guidelineLineIndexRepresentationFactory(obj):
+    lines = [
+        normalizeGuidelineGeometry(guideline.x, guideline.y, guideline.angle)
+        for guideline in obj.guidelines
+    ]
+    return GuidelineLineIndex(lines)
+
+defcon.registerRepresentationFactory(
+    defcon.Glyph,
+    guidelineLineIndexKey,
+    guidelineLineIndexRepresentationFactory,
+    destructiveNotifications=(
+        "Glyph.GuidelinesChanged",
+    )
+)
+
+defcon.registerRepresentationFactory(
+    defcon.Font,
+    guidelineLineIndexKey,
+    guidelineLineIndexRepresentationFactory,
+    destructiveNotifications=(
+        "Font.GuidelinesChanged",
+    )
+)
+
+# Snap Sources
+# ------------
+# Each kind of snap to point comes from a source
+# that is switched on with an extension default.
+# A source is called with the tool and the glyph
+# and returns the points, or None if the points
+# are not ready yet. The points of the enabled
+# sources are combined into one index per gesture,
+# so the drag only queries one index no matter
+# how many sources are enabled.
+
+snapSources = {}
+
+def registerSnapSource(name, defaultKey, function):
+    snapSources[name] = (defaultKey, function)
+
+def pointSnapSource(tool, glyph):
+    return glyph.getRepresentation(glyphPointsKey)
+
+def futurePointSnapSource(tool, glyph):
+    return tool.getFuturePointsJob(glyph).points
+
+def offCurvePointSnapSource(tool, glyph):
+    return glyph.getRepresentation(offCurvePointsKey)
+
+def extremePointSnapSource(tool, glyph):
+    return glyph.getRepresentation(extremePointsKey)
+
+def anchorSnapSource(tool, glyph):
+    return glyph.getRepresentation(anchorPointsKey)
+
+def verticalMetricsSnapSource(tool, glyph):
+    font = glyph.font
+    if font is None:
+        return ()
+    values = font.info.naked().getRepresentation(verticalMetricsKey)
+    points = set()
+    for x in (0, glyph.width):
+        for y in values:
+            points.add((x, y))
+    return points
+
+def guidelineIntersectionSnapSource(tool, glyph):
+    # the selected guidelines are the ones
+    # being moved, so they are left out
+    lines = []
+    registry = tool.getGuidelineRegistry()
+    for key in ("font", "glyph"):
+        for guideline in registry.getGuidelines(key):
+            if guideline in tool.selectedGuidelines:
+                continue
+            lines.append(
+                normalizeGuidelineGeometry(guideline.x, guideline.y, guideline.angle)
+            )
+    return findGuidelineCrossings(lines)
+
+registerSnapSource("point", "snapToPoint", pointSnapSource)
+registerSnapSource("futurePoint", "snapToFuturePoint", futurePointSnapSource)
+registerSnapSource("offCurvePoint", "snapToOffCurvePoint", offCurvePointSnapSource)
+registerSnapSource("extremePoint", "snapToExtremePoint", extremePointSnapSource)
+registerSnapSource("anchor", "snapToAnchor", anchorSnapSource)
+registerSnapSource("verticalMetrics", "snapToVerticalMetrics", verticalMetricsSnapSource)
+registerSnapSource("guidelineIntersection", "snapToGuidelineIntersection", guidelineIntersectionSnapSource)
+
+offCurvePointsKey = extensionIdentifier + ".offCurvePoints"
+
+def offCurvePointsRepresentationFactory(glyph):
+    return frozenset(
+        (point.x, point.y)
+        for contour in glyph
+        for point in contour
+        if point.segmentType is None
+    )
+
+defcon.registerRepresentationFactory(
+    defcon.Glyph,
+    offCurvePointsKey,
+    offCurvePointsRepresentationFactory,
+    destructiveNotifications=(
+        "Glyph.ContoursChanged",
+    )
+)
+
+extremePointsKey = extensionIdentifier + ".extremePoints"
+
+def extremePointsRepresentationFactory(glyph):
+    pen = ContourSegmentsPen()
+    for contour in glyph:
+        contour.draw(pen)
+    return frozenset(findSegmentExtrema(pen.segments))
+
+defcon.registerRepresentationFactory(
+    defcon.Glyph,
+    extremePointsKey,
+    extremePointsRepresentationFactory,
+    destructiveNotifications=(
+        "Glyph.ContoursChanged",
+    )
+)
+
+anchorPointsKey = extensionIdentifier + ".anchorPoints"
+
+def anchorPointsRepresentationFactory(glyph):
+    return frozenset(
+        (anchor.x, anchor.y)
+        for anchor in glyph.anchors
+    )
+
+defcon.registerRepresentationFactory(
+    defcon.Glyph,
+    anchorPointsKey,
+    anchorPointsRepresentationFactory,
+    destructiveNotifications=(
+        "Glyph.AnchorsChanged",
+    )
+)
+
+verticalMetricsKey = extensionIdentifier + ".verticalMetrics"
+
+verticalMetricsAttributes = (
+    "descender",
+    "xHeight",
+    "capHeight",
+    "ascender"
+)
+
+def verticalMetricsRepresentationFactory(info):
+    values = {0}
+    for attr in verticalMetricsAttributes:
+        value = getattr(info, attr)
+        if value is not None:
+            values.add(value)
+    return frozenset(values)
+
+defcon.registerRepresentationFactory(
+    defcon.Info,
+    verticalMetricsKey,
+    verticalMetricsRepresentationFactory,
+    destructiveNotifications=(
+        "Info.Changed",
+    )
+)
+
 # -------
 # Install
 # -------
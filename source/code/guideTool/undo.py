@@ -0,0 +1,242 @@
+import weakref
+from .compatibility import holdGuidelineParentNotifications
+
+# ----------
+# Undo Group
+# ----------
+#
+# Changes made to guidelines by the tool are
+# recorded as deltas that only hold the state
+# of the guidelines that were changed, instead
+# of a snapshot of the whole glyph. A delta is
+# (parent, identifier, before, after, index) where
+# the parent is the defcon glyph or font, before
+# and after are guideline states and index is the
+# position of the guideline in its parent. A state
+# of None means that the guideline does not exist.
+# Removed guidelines are inserted at their index
+# again when the removal is undone.
+# Guidelines are found by their identifier, or by
+# their whole state if they don't have one, so
+# recording never writes identifiers to the model.
+# The deltas of a gesture are registered as one
+# undo action with an NSUndoManager. This works
+# the same way for glyph and font guidelines.
+
+stateKeys = ("x", "y", "angle", "name", "color", "identifier")
+optionalStateKeys = ("visible", "magnetic", "showMeasurements")
+
+class GuidelineUndoGroup:
+
+    """
+    Collect the guideline changes of one gesture.
+
+    >>> import defcon
+    >>> glyph = defcon.Glyph()
+    >>> glyph.appendGuideline(dict(x=10, y=0, angle=90))
+    >>> guideline = glyph.guidelines[0]
+    >>> group = GuidelineUndoGroup()
+    >>> group.recordGuideline(guideline, "Move Guideline")
+    >>> guideline.x = 20
+    >>> group.recordGuideline(guideline, "Move Guideline")
+    >>> guideline.x = 30
+    >>> added = glyph.instantiateGuideline(dict(x=0, y=5, angle=0))
+    >>> glyph.appendGuideline(added)
+    >>> added = glyph.guidelines[-1]
+    >>> group.recordAddedGuideline(added, "Add Guideline")
+    >>> group.actionName
+    'Move Guideline'
+    >>> deltas = group.getDeltas()
+    >>> len(deltas)
+    2
+    >>> [(before and before["x"], after["x"]) for parent, identifier, before, after, index in deltas]
+    [(None, 0), (10, 30)]
+
+    Undo the changes.
+
+    >>> applyGuidelineDeltas(invertGuidelineDeltas(deltas))
+    >>> [(g.x, g.y) for g in glyph.guidelines]
+    [(10, 0)]
+
+    Redo the changes.
+
+    >>> applyGuidelineDeltas(deltas)
+    >>> [(g.x, g.y) for g in glyph.guidelines]
+    [(30, 0), (0, 5)]
+
+    Unchanged guidelines are left out.
+
+    >>> group = GuidelineUndoGroup()
+    >>> group.recordGuideline(glyph.guidelines[0], "Move Guideline")
+    >>> group.getDeltas()
+    []
+
+    Guidelines that are removed after they are
+    recorded have no state after the change.
+
+    >>> group = GuidelineUndoGroup()
+    >>> for guideline in glyph.guidelines:
+    ...     group.recordGuideline(guideline, "Delete Guidelines")
+    >>> glyph.clearGuidelines()
+    >>> deltas = group.getDeltas()
+    >>> [(before["x"], after) for parent, identifier, before, after, index in deltas]
+    [(0, None), (30, None)]
+    >>> applyGuidelineDeltas(invertGuidelineDeltas(deltas))
+    >>> [(g.x, g.y) for g in glyph.guidelines]
+    [(30, 0), (0, 5)]
+    >>> [g.identifier for g in glyph.guidelines]
+    [None, None]
+    >>> applyGuidelineDeltas(deltas)
+    >>> glyph.guidelines
+    []
+    """
+
+    def __init__(self):
+        self.actionName = None
+        self.records = {}
+
+    def _record(self, guideline, actionName, before):
+        guideline = getNakedGuideline(guideline)
+        key = id(guideline)
+        if key in self.records:
+            return
+        if self.actionName is None:
+            self.actionName = actionName
+        parent = guideline.glyph
+        if parent is None:
+            parent = guideline.font
+        index = 0
+        for index, g in enumerate(parent.guidelines):
+            if g is guideline:
+                break
+        self.records[key] = (guideline, parent, before, index)
+
+    def recordGuideline(self, guideline, actionName):
+        """
+        Record the state of a guideline before
+        it is changed or removed. Only the first
+        call for a guideline is used.
+        """
+        self._record(guideline, actionName, getGuidelineUndoState(guideline))
+
+    def recordAddedGuideline(self, guideline, actionName):
+        """
+        Record a guideline that was added.
+        """
+        self._record(guideline, actionName, None)
+
+    def getDeltas(self):
+        deltas = []
+        present = {}
+        for guideline, parent, before, index in self.records.values():
+            parentKey = id(parent)
+            if parentKey not in present:
+                present[parentKey] = {id(g) for g in parent.guidelines}
+            after = None
+            if id(guideline) in present[parentKey]:
+                after = getGuidelineUndoState(guideline)
+            if before == after:
+                continue
+            identifier = (before or after)["identifier"]
+            deltas.append((parent, identifier, before, after, index))
+        # removals are applied from the last index down
+        # so that the inverse inserts from the first up
+        deltas.sort(key=lambda delta: -delta[4])
+        return deltas
+
+    def register(self, undoManager, callback=None):
+        """
+        Register the recorded changes as one undo
+        action. The callback is called after the
+        changes are undone or redone.
+        """
+        deltas = self.getDeltas()
+        if not deltas:
+            return False
+        registerGuidelineDeltas(undoManager, deltas, self.actionName, callback)
+        return True
+
+
+def getNakedGuideline(guideline):
+    if hasattr(guideline, "naked"):
+        return guideline.naked()
+    return guideline
+
+def getGuidelineUndoState(guideline):
+    guideline = getNakedGuideline(guideline)
+    state = {key : getattr(guideline, key) for key in stateKeys}
+    for key in optionalStateKeys:
+        if hasattr(guideline, key):
+            state[key] = getattr(guideline, key)
+    return state
+
+def invertGuidelineDeltas(deltas):
+    return [
+        (parent, identifier, after, before, index)
+        for parent, identifier, before, after, index in reversed(deltas)
+    ]
+
+def applyGuidelineDeltas(deltas):
+    parents = []
+    for parent, identifier, before, after, index in deltas:
+        if not any(p is parent for p in parents):
+            parents.append(parent)
+    with holdGuidelineParentNotifications(parents, note="Guide Tool undo"):
+        _applyGuidelineDeltas(deltas)
+
+def _applyGuidelineDeltas(deltas):
+    for parent, identifier, before, after, index in deltas:
+        guideline = None
+        if before is not None:
+            guideline = _findGuideline(parent, before)
+        if after is None:
+            if guideline is not None:
+                parent.removeGuideline(guideline)
+        elif guideline is None:
+            guideline = parent.instantiateGuideline(
+                {key : after[key] for key in stateKeys}
+            )
+            parent.insertGuideline(index, guideline)
+            for key in optionalStateKeys:
+                if key in after:
+                    setattr(guideline, key, after[key])
+        else:
+            guideline.x = after["x"]
+            guideline.y = after["y"]
+            guideline.angle = after["angle"]
+
+def _findGuideline(parent, state):
+    identifier = state["identifier"]
+    for guideline in parent.guidelines:
+        if identifier is not None:
+            if guideline.identifier == identifier:
+                return guideline
+        elif getGuidelineUndoState(guideline) == state:
+            return guideline
+    return None
+
+def registerGuidelineDeltas(undoManager, deltas, actionName, callback=None):
+    """
+    Register the inverse of the deltas with the undo
+    manager. When it is performed, the deltas are
+    registered again so that the action can be redone.
+    The callback is held weakly.
+    """
+    if callback is not None and not isinstance(callback, weakref.ref):
+        if hasattr(callback, "__self__"):
+            callback = weakref.WeakMethod(callback)
+        else:
+            callback = weakref.ref(callback)
+    inverse = invertGuidelineDeltas(deltas)
+
+    def handler(target):
+        applyGuidelineDeltas(inverse)
+        registerGuidelineDeltas(undoManager, inverse, actionName, callback)
+        if callback is not None:
+            function = callback()
+            if function is not None:
+                function()
+
+    undoManager.registerUndoWithTarget_handler_(undoManager, handler)
+    if actionName:
+        undoManager.setActionName_(actionName)